@@ -1,11 +1,24 @@
-from flask import Flask, request, jsonify, send_file, abort, redirect
+from flask import Flask, Response, request, jsonify, abort, redirect
 from flask_cors import CORS
+from werkzeug.wsgi import ClosingIterator
+from werkzeug.http import http_date
 import os
 import hashlib
 import threading
 import time
 from datetime import datetime
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 import tempfile
+import subprocess
+import json
+import re
+import copy
+import sqlite3
+import socket
+import shutil
+import zipfile
+from urllib.parse import quote, urlsplit, urlunsplit
 
 app = Flask(__name__)
 CORS(app)
@@ -14,19 +27,1211 @@ CORS(app)
 TEMP_DIR = os.path.join(os.getcwd(), 'temp_files')
 os.makedirs(TEMP_DIR, exist_ok=True)
 
-# 任务存储
+# 视频信息缓存: 条目数上限、有效期和提取失败结果的有效期 (秒)
+METADATA_CACHE_SIZE = int(os.environ.get('METADATA_CACHE_SIZE', 256))
+METADATA_TTL = int(os.environ.get('METADATA_TTL', 3600))
+METADATA_NEGATIVE_TTL = int(os.environ.get('METADATA_NEGATIVE_TTL', 60))
+
+# 缓存容量上限 (字节)；超过高水位时淘汰到低水位，磁盘剩余空间低于下限时也会淘汰
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+CACHE_HIGH_WATERMARK = float(os.environ.get('CACHE_HIGH_WATERMARK', 0.9))
+CACHE_LOW_WATERMARK = float(os.environ.get('CACHE_LOW_WATERMARK', 0.7))
+CACHE_MIN_FREE_BYTES = int(os.environ.get('CACHE_MIN_FREE_BYTES', 1024 * 1024 * 1024))
+
+# 淘汰顺序: 最后访问时间加上每次命中的奖励秒数 (最多计CACHE_HIT_CAP次)，分数最低的先淘汰
+CACHE_HIT_BONUS = int(os.environ.get('CACHE_HIT_BONUS', 900))
+CACHE_HIT_CAP = 8
+
+# 本进程记住的文件哈希条数 (LRU)，超出后从sidecar重新读取
+HASH_CACHE_SIZE = 1024
+
+# 下载前按估算大小预留磁盘空间: 估算的放大系数、空间不够时最长等待时间和重试间隔 (秒)
+DISK_ESTIMATE_MARGIN = 1.2
+DISK_WAIT_TIMEOUT = int(os.environ.get('DISK_WAIT_TIMEOUT', 600))
+DISK_RETRY_SECONDS = 5
+
+# 定时检查水位的间隔，以及清理没有登记在索引中的残留文件的间隔和存活时间 (秒)
+CACHE_SWEEP_INTERVAL = int(os.environ.get('CACHE_SWEEP_INTERVAL', 300))
+ORPHAN_SWEEP_INTERVAL = 3600
+ORPHAN_MAX_AGE = 7200
+
+# 转换线程池大小和等待队列长度
+CONVERT_WORKERS = int(os.environ.get('CONVERT_WORKERS', 4))
+CONVERT_QUEUE_SIZE = int(os.environ.get('CONVERT_QUEUE_SIZE', 32))
+RETRY_AFTER_SECONDS = int(os.environ.get('RETRY_AFTER_SECONDS', 30))
+
+# 长轮询最长等待时间、SSE心跳间隔和最短推送间隔 (秒)
+LONG_POLL_TIMEOUT = 25
+SSE_KEEPALIVE_SECONDS = 15
+STATUS_PUSH_INTERVAL = 0.5
+
+# 每个长轮询/SSE连接占用一个gthread线程，最多同时挂起这么多个 (默认线程数的一半)，
+# 超出时立即返回当前状态，客户端按 poll_after 秒短轮询
+MAX_STATUS_WATCHERS = int(os.environ.get('MAX_STATUS_WATCHERS', 16))
+STATUS_SHORT_POLL_SECONDS = 2
+
+# 流式下载每次读取的字节数
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# 一个请求最多处理的Range数量，超过时返回整个文件
+MAX_RANGES = 16
+
+# 转码线程数默认等于CPU核数
+TRANSCODE_WORKERS = int(os.environ.get('TRANSCODE_WORKERS', os.cpu_count() or 1))
+
+# 任务持久化存储: sqlite (默认) / file / memory
+TASK_STORE = os.environ.get('TASK_STORE', 'sqlite')
+DATA_DIR = os.environ.get('DATA_DIR', os.path.join(os.getcwd(), 'data'))
+
+# 进度类变化写入存储的最短间隔 (秒)，状态变化总是立即写入
+PERSIST_INTERVAL = 1.0
+
+# 其他主机上的未完成任务超过这个时间没有更新，认为其worker已经退出，由本进程接管
+RESUME_STALE_SECONDS = int(os.environ.get('RESUME_STALE_SECONDS', 120))
+
+# 批量转换: 单次最多的视频数和每批同时转换的视频数
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 200))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 2))
+
+# 结束的任务在内存中保留的时间，之后只从存储读取；存储中的记录保留TASK_TTL秒 (都可用环境变量修改)
+TASK_HOT_SECONDS = int(os.environ.get('TASK_HOT_SECONDS', 600))
+TASK_TTL = int(os.environ.get('TASK_TTL', 24 * 3600))
+
+# /debug 最多显示的已结束任务数
+DEBUG_RECENT_TASKS = 20
+
+# 本进程中运行的任务 (以及刚结束的任务)
 tasks = {}
 
+# 本进程创建的批量任务记录
+batches = {}
+
 class Task:
-    def __init__(self, task_id, url):
+    # 长期运行的worker中任务很多，用__slots__省去每个对象的__dict__
+    __slots__ = ('version', 'changed', 'task_id', 'url', 'video_id', 'formats', 'status', 'progress', 'stages',
+                 'video_info', 'files', 'error', 'created_at', 'finished_at', 'leader', 'followers', 'following',
+                 'produce', 'inflight_keys', 'stream_formats', 'checkpoint', 'owner', 'persisted_at', 'dirty')
+
+    # 这些字段变化时递增version并唤醒等待状态的请求
+    WATCHED_FIELDS = frozenset(['status', 'progress', 'stages', 'video_info', 'files', 'error', 'checkpoint'])
+    FINISHED_STATUSES = ('completed', 'error')
+
+    def __init__(self, task_id, url, formats=None):
+        self.version = 0
+        self.changed = threading.Condition()
         self.task_id = task_id
         self.url = url
+        self.formats = formats or DEFAULT_FORMATS
+        self.video_id = canonical_video_id(url)
+        self.finished_at = None
         self.status = 'pending'
         self.progress = 0
+        self.stages = {}
         self.video_info = None
         self.files = {}
         self.error = None
         self.created_at = datetime.now()
+        # leader: 本任务只在等待其他任务时显示其进度；following: 格式 -> 正在生成它的任务；
+        # produce: 本任务自己生成的格式
+        self.leader = None
+        self.followers = []
+        self.following = {}
+        self.produce = ()
+        self.inflight_keys = []
+        self.stream_formats = []
+        self.checkpoint = None
+        self.owner = worker_id()
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name == 'status':
+            object.__setattr__(self, 'finished_at', time.time() if value in Task.FINISHED_STATUSES else None)
+        if name in Task.WATCHED_FIELDS:
+            self.notify_changed(force_persist=name not in ('progress', 'stages'))
+
+    def notify_changed(self, force_persist=True):
+        """状态有变化: 递增version，唤醒本任务和合并进来的任务的等待者，并写入存储"""
+        # __init__ 还没设置完的字段用getattr的默认值
+        changed = getattr(self, 'changed', None)
+        if changed is None:
+            return
+        with changed:
+            self.version += 1
+            changed.notify_all()
+        if tasks.get(self.task_id) is self:
+            now = time.time()
+            if force_persist or now - getattr(self, 'persisted_at', 0) >= PERSIST_INTERVAL:
+                object.__setattr__(self, 'persisted_at', now)
+                object.__setattr__(self, 'dirty', False)
+                save_task(self)
+            else:
+                # 跳过的写入由flush_dirty_tasks补上
+                object.__setattr__(self, 'dirty', True)
+        for follower in getattr(self, 'followers', ()):
+            follower.notify_changed(force_persist)
+
+    def to_record(self):
+        """写入任务存储的字段，合并进来的任务记录主任务的进度"""
+        source = self
+        if self.leader is not None and self.status == 'processing':
+            source = self.leader
+        return {
+            'task_id': self.task_id,
+            'url': self.url,
+            'video_id': self.video_id,
+            'formats': list(self.formats),
+            'status': self.status,
+            'progress': source.progress,
+            'stages': source.stages,
+            'video_info': self.video_info,
+            'files': self.files,
+            'error': self.error,
+            'created_at': self.created_at.isoformat(),
+            'finished_at': self.finished_at,
+            'version': self.version,
+            'checkpoint': self.checkpoint,
+            'owner': self.owner,
+            'updated_at': time.time(),
+        }
+
+    @classmethod
+    def from_record(cls, record):
+        """从存储记录还原只读快照 (其他worker进程的任务)"""
+        task = cls.__new__(cls)
+        values = dict(record, formats=tuple(record['formats']), video_id=record.get('video_id'),
+                      created_at=datetime.fromisoformat(record['created_at']),
+                      finished_at=record.get('finished_at'),
+                      leader=None, followers=[], following={}, produce=(), inflight_keys=[], stream_formats=[])
+        for name, value in values.items():
+            if name in cls.__slots__:
+                object.__setattr__(task, name, value)
+        return task
+
+    @classmethod
+    def restore(cls, record):
+        """从存储记录重建由本进程继续执行的任务"""
+        task = cls(record['task_id'], record['url'], tuple(record['formats']))
+        task.created_at = datetime.fromisoformat(record['created_at'])
+        task.video_info = record.get('video_info')
+        task.files = record.get('files') or {}
+        task.progress = record.get('progress', 0)
+        task.checkpoint = record.get('checkpoint')
+        return task
+
+    def wait_changed(self, since, timeout):
+        """等待version不等于since，返回当前version"""
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != since, timeout)
+            return self.version
+
+def process_start_time(pid):
+    """进程的启动时间 (Linux的/proc中自开机以来的时钟数)，无法读取时返回None"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return f.read().rpartition(')')[2].split()[19]
+    except (OSError, IndexError):
+        return None
+
+# pid -> 进程标识，fork出的进程pid不同，会生成自己的标识
+worker_ids = {}
+
+def worker_id():
+    """当前进程标识 主机名:pid:启动时间；容器重启后pid相同时也能区分新旧进程"""
+    pid = os.getpid()
+    ident = worker_ids.get(pid)
+    if ident is None:
+        ident = worker_ids[pid] = f'{socket.gethostname()}:{pid}:{process_start_time(pid) or os.urandom(4).hex()}'
+    return ident
+
+def connect_sqlite(path):
+    """WAL模式的SQLite连接，多个线程共用 (调用方加锁)"""
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+class SQLiteTaskStore:
+    """SQLite (WAL模式) 任务存储，多个worker进程共享同一个数据库文件"""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.pid = None
+        self._conn = None
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                data TEXT NOT NULL
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (status, updated_at)')
+
+    @property
+    def conn(self):
+        """fork出的子进程重新连接，不能沿用父进程的连接"""
+        if self.pid != os.getpid():
+            self._conn = connect_sqlite(self.path)
+            self.pid = os.getpid()
+        return self._conn
+
+    def save(self, record):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO tasks (task_id, status, updated_at, data) VALUES (?, ?, ?, ?)',
+                (record['task_id'], record['status'], time.time(), json.dumps(record))
+            )
+
+    def load(self, task_id):
+        with self.lock:
+            row = self.conn.execute('SELECT data FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def delete(self, task_id):
+        with self.lock:
+            self.conn.execute('DELETE FROM tasks WHERE task_id = ?', (task_id,))
+
+    def claim(self, task_id, expected_owner, new_owner):
+        """owner仍是expected_owner时改为new_owner并返回记录，多个worker中只有一个成功"""
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute('SELECT data FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+                record = json.loads(row[0]) if row else None
+                if record is None or record.get('owner') != expected_owner:
+                    self.conn.execute('ROLLBACK')
+                    return None
+                record['owner'] = new_owner
+                self.conn.execute('UPDATE tasks SET data = ?, updated_at = ? WHERE task_id = ?',
+                                  (json.dumps(record), time.time(), task_id))
+                self.conn.execute('COMMIT')
+                return record
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def find_by_status(self, status):
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT data FROM tasks WHERE status = ? ORDER BY updated_at', (status,)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def count_by_status(self):
+        with self.lock:
+            rows = self.conn.execute('SELECT status, COUNT(*) FROM tasks GROUP BY status').fetchall()
+        return dict(rows)
+
+    def expire(self, statuses, before):
+        """删除这些状态中updated_at早于before的记录，返回删除数量"""
+        with self.lock:
+            cursor = self.conn.execute(
+                f'DELETE FROM tasks WHERE status IN ({", ".join("?" * len(statuses))}) AND updated_at < ?',
+                (*statuses, before)
+            )
+        return cursor.rowcount
+
+class FileTaskStore:
+    """共享目录任务存储，每个任务一个JSON文件，原子替换写入"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, task_id):
+        return os.path.join(self.directory, f'{task_id}.json')
+
+    def save(self, record):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(record, f)
+        os.replace(temp_path, self._path(record['task_id']))
+
+    def load(self, task_id):
+        try:
+            with open(self._path(task_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def delete(self, task_id):
+        try:
+            os.remove(self._path(task_id))
+        except OSError:
+            pass
+
+    def claim(self, task_id, expected_owner, new_owner):
+        # 用独占创建的锁文件保证只有一个进程能接管
+        lock_path = self._path(task_id) + '.lock'
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+        try:
+            record = self.load(task_id)
+            if record is None or record.get('owner') != expected_owner:
+                return None
+            record['owner'] = new_owner
+            self.save(record)
+            return record
+        finally:
+            os.close(fd)
+            os.remove(lock_path)
+
+    def _records(self):
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.json'):
+                record = self.load(filename[:-5])
+                if record is not None:
+                    yield record
+
+    def find_by_status(self, status):
+        return [record for record in self._records() if record['status'] == status]
+
+    def count_by_status(self):
+        counts = {}
+        for record in self._records():
+            counts[record['status']] = counts.get(record['status'], 0) + 1
+        return counts
+
+    def expire(self, statuses, before):
+        expired = [record['task_id'] for record in self._records()
+                   if record['status'] in statuses and record.get('updated_at', 0) < before]
+        for task_id in expired:
+            self.delete(task_id)
+        return len(expired)
+
+class MemoryTaskStore:
+    """进程内任务存储，只适合单worker开发环境"""
+
+    def __init__(self):
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def save(self, record):
+        with self.lock:
+            self.records[record['task_id']] = record
+
+    def load(self, task_id):
+        with self.lock:
+            return self.records.get(task_id)
+
+    def delete(self, task_id):
+        with self.lock:
+            self.records.pop(task_id, None)
+
+    def claim(self, task_id, expected_owner, new_owner):
+        with self.lock:
+            record = self.records.get(task_id)
+            if record is None or record.get('owner') != expected_owner:
+                return None
+            record = dict(record, owner=new_owner)
+            self.records[task_id] = record
+            return record
+
+    def find_by_status(self, status):
+        with self.lock:
+            return [record for record in self.records.values() if record['status'] == status]
+
+    def count_by_status(self):
+        with self.lock:
+            counts = {}
+            for record in self.records.values():
+                counts[record['status']] = counts.get(record['status'], 0) + 1
+            return counts
+
+    def expire(self, statuses, before):
+        with self.lock:
+            expired = [task_id for task_id, record in self.records.items()
+                       if record['status'] in statuses and record.get('updated_at', 0) < before]
+            for task_id in expired:
+                del self.records[task_id]
+            return len(expired)
+
+def create_task_store(kind):
+    if kind == 'sqlite':
+        return SQLiteTaskStore(os.path.join(DATA_DIR, 'tasks.db'))
+    if kind == 'file':
+        return FileTaskStore(os.path.join(DATA_DIR, 'tasks'))
+    if kind == 'memory':
+        return MemoryTaskStore()
+    raise ValueError(f'未知的TASK_STORE: {kind}')
+
+task_store = create_task_store(TASK_STORE)
+
+def save_task(task):
+    try:
+        task_store.save(task.to_record())
+    except Exception as e:
+        print(f"Task store error: {e}")
+
+def flush_dirty_tasks():
+    """写入节流期间跳过的进度，其他worker最多晚PERSIST_INTERVAL秒看到"""
+    for task in list(tasks.values()):
+        if getattr(task, 'dirty', False):
+            object.__setattr__(task, 'persisted_at', time.time())
+            object.__setattr__(task, 'dirty', False)
+            save_task(task)
+
+def find_task(task_id):
+    """先找本进程的任务，再查共享存储中其他worker的任务"""
+    task = tasks.get(task_id)
+    if task is not None:
+        return task
+    record = task_store.load(task_id)
+    if record is None or record.get('kind') == 'batch':
+        return None
+    return Task.from_record(record)
+
+# 挂起中的长轮询/SSE连接数
+status_watchers = threading.BoundedSemaphore(MAX_STATUS_WATCHERS)
+
+def wait_task(task, since, timeout):
+    """等待任务version变化，返回最新的任务对象"""
+    if tasks.get(task.task_id) is task:
+        task.wait_changed(since, timeout)
+        return task
+    # 其他worker的任务只能轮询存储
+    deadline = time.time() + timeout
+    while task.version == since and time.time() < deadline:
+        time.sleep(STATUS_PUSH_INTERVAL)
+        task = find_task(task.task_id) or task
+    return task
+
+class MetadataCache:
+    """视频信息缓存: TTL过期 + LRU条目上限，提取失败的结果使用更短的TTL"""
+
+    def __init__(self, max_entries, ttl, negative_ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry['expires_at'] <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, raw_info, info):
+        return self._store(key, {'raw': raw_info, 'info': info, 'expires_at': time.time() + self.ttl})
+
+    def put_error(self, key, error):
+        return self._store(key, {'error': error, 'expires_at': time.time() + self.negative_ttl})
+
+    def _store(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+# 缓存完整提取结果时丢弃的字段 (下载用不到且体积大)
+RAW_INFO_DROP_FIELDS = (
+    'automatic_captions', 'subtitles', 'requested_subtitles',
+    'thumbnails', 'heatmap', 'chapters', 'description',
+)
+
+metadata_cache = MetadataCache(METADATA_CACHE_SIZE, METADATA_TTL, METADATA_NEGATIVE_TTL)
+# 正在提取的视频: 键 -> {lock, users}
+metadata_locks = {}
+metadata_locks_guard = threading.Lock()
+
+class ArtifactIndex:
+    """转换结果索引 (SQLite): (视频ID, 格式) -> 路径、大小、哈希、创建时间、最后访问时间和命中次数
+    
+    按主键查找，不扫描TEMP_DIR；重启后保留，多个worker进程共享同一个数据库文件。
+    """
+
+    COLUMNS = ('video_id', 'format_type', 'path', 'filename', 'size', 'hash', 'created_at', 'last_access', 'hits')
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.pid = None
+        self._conn = None
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS artifacts (
+                video_id TEXT NOT NULL,
+                format_type TEXT NOT NULL,
+                path TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                hash TEXT,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (video_id, format_type)
+            )
+        ''')
+        # 旧版本创建的表没有hits列
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(artifacts)')]
+        if 'hits' not in columns:
+            self.conn.execute('ALTER TABLE artifacts ADD COLUMN hits INTEGER NOT NULL DEFAULT 0')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_artifacts_path ON artifacts (path)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_artifacts_access ON artifacts (last_access)')
+        # 进行中的任务预留的磁盘空间，按主机统计 (同一主机的worker共用一块磁盘)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS reservations (
+                task_id TEXT PRIMARY KEY,
+                host TEXT NOT NULL,
+                owner TEXT NOT NULL,
+                bytes INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+
+    @property
+    def conn(self):
+        if self.pid != os.getpid():
+            self._conn = connect_sqlite(self.path)
+            self.pid = os.getpid()
+        return self._conn
+
+    def _select(self, where, params):
+        with self.lock:
+            rows = self.conn.execute(f'SELECT {", ".join(self.COLUMNS)} FROM artifacts {where}', params).fetchall()
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+
+    def get(self, video_id, format_type):
+        """查找并更新最后访问时间和命中次数"""
+        rows = self._select('WHERE video_id = ? AND format_type = ?', (video_id, format_type))
+        if not rows:
+            return None
+        with self.lock:
+            self.conn.execute('UPDATE artifacts SET last_access = ?, hits = hits + 1 WHERE video_id = ? AND format_type = ?',
+                              (time.time(), video_id, format_type))
+        return rows[0]
+
+    def find_by_path(self, path):
+        rows = self._select('WHERE path = ?', (path,))
+        return rows[0] if rows else None
+
+    def put(self, video_id, format_type, path, filename, size, hash):
+        now = time.time()
+        with self.lock:
+            # 重新生成的文件保留原来的命中次数
+            self.conn.execute(
+                'INSERT OR REPLACE INTO artifacts (video_id, format_type, path, filename, size, hash, created_at, last_access, hits) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, COALESCE((SELECT hits FROM artifacts WHERE video_id = ? AND format_type = ?), 0))',
+                (video_id, format_type, path, filename, size, hash, now, now, video_id, format_type)
+            )
+
+    def delete(self, video_id, format_type):
+        with self.lock:
+            self.conn.execute('DELETE FROM artifacts WHERE video_id = ? AND format_type = ?', (video_id, format_type))
+
+    def total_bytes(self):
+        with self.lock:
+            return self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM artifacts').fetchone()[0]
+
+    def reserve(self, task_id, nbytes, available):
+        """本主机的预留总量加上nbytes不超过available时登记预留，多个worker之间原子判断"""
+        host = socket.gethostname()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                reserved = self.conn.execute(
+                    'SELECT COALESCE(SUM(bytes), 0) FROM reservations WHERE host = ? AND task_id != ?', (host, task_id)
+                ).fetchone()[0]
+                if reserved + nbytes > available:
+                    self.conn.execute('ROLLBACK')
+                    return False
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO reservations (task_id, host, owner, bytes, updated_at) VALUES (?, ?, ?, ?, ?)',
+                    (task_id, host, worker_id(), nbytes, time.time())
+                )
+                self.conn.execute('COMMIT')
+                return True
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def update_reservation(self, task_id, nbytes):
+        with self.lock:
+            self.conn.execute('UPDATE reservations SET bytes = ?, updated_at = ? WHERE task_id = ?',
+                              (nbytes, time.time(), task_id))
+
+    def release_reservation(self, task_id):
+        with self.lock:
+            self.conn.execute('DELETE FROM reservations WHERE task_id = ?', (task_id,))
+
+    def reservations(self):
+        with self.lock:
+            rows = self.conn.execute('SELECT task_id, owner, updated_at FROM reservations WHERE host = ?',
+                                     (socket.gethostname(),)).fetchall()
+        return [{'task_id': task_id, 'owner': owner, 'updated_at': updated_at} for task_id, owner, updated_at in rows]
+
+    def reserved_bytes(self):
+        with self.lock:
+            return self.conn.execute('SELECT COALESCE(SUM(bytes), 0) FROM reservations WHERE host = ?',
+                                     (socket.gethostname(),)).fetchone()[0]
+
+    def eviction_order(self, hit_bonus, hit_cap):
+        """按 最后访问时间 + 命中奖励 从低到高排列: 近期没人下载、下载次数少的先淘汰"""
+        return self._select('ORDER BY last_access + ? * MIN(hits, ?)', (hit_bonus, hit_cap))
+
+class ConversionCache:
+    """转换结果缓存: 持久化的索引 + 本进程中的引用计数，按水位淘汰"""
+
+    def __init__(self, index, max_bytes, high_watermark, low_watermark, min_free_bytes):
+        self.index = index
+        self.max_bytes = max_bytes
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.min_free_bytes = min_free_bytes
+        self.refs = {}
+        self.hashes = OrderedDict()
+        self.lock = threading.Lock()
+        self.evict_lock = threading.Lock()
+        # 淘汰或释放预留后通知等待磁盘空间的任务
+        self.space_freed = threading.Condition()
+
+    def get(self, video_id, format_type):
+        entry = self.index.get(video_id, format_type)
+        if entry is None:
+            return None
+        if not os.path.exists(entry['path']):
+            self.index.delete(video_id, format_type)
+            return None
+        return entry
+
+    def put(self, video_id, format_type, path, filename):
+        # 在转换线程里算好哈希，第一次下载不用等待
+        self.index.put(video_id, format_type, path, filename, os.path.getsize(path), self.digest(path))
+        self.evict()
+
+    def digest(self, path):
+        """文件内容的SHA-256，用作强ETag；优先使用sidecar和索引中记录的哈希，按修改时间和大小缓存结果"""
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            cached = self.hashes.get(path)
+            if cached is not None and cached[0] == stamp:
+                self.hashes.move_to_end(path)
+                return cached[1]
+        entry = self.index.find_by_path(path)
+        meta = read_sidecar(path)
+        if meta and meta.get('sha256'):
+            digest = meta['sha256']
+        elif entry and entry['hash'] and entry['size'] == stat.st_size and entry['created_at'] >= stat.st_mtime:
+            digest = entry['hash']
+        else:
+            digest = file_sha256(path)
+        with self.lock:
+            self.hashes[path] = (stamp, digest)
+            self.hashes.move_to_end(path)
+            # 其他worker淘汰或替换的文件不会通知本进程，只保留最近用过的
+            while len(self.hashes) > HASH_CACHE_SIZE:
+                self.hashes.popitem(last=False)
+        return digest
+
+    def acquire(self, path):
+        with self.lock:
+            self.refs[path] = self.refs.get(path, 0) + 1
+
+    def release(self, path):
+        with self.lock:
+            count = self.refs.get(path, 0) - 1
+            if count > 0:
+                self.refs[path] = count
+            else:
+                self.refs.pop(path, None)
+
+    def is_pinned(self, path):
+        with self.lock:
+            return self.refs.get(path, 0) > 0
+
+    def total_bytes(self):
+        return self.index.total_bytes()
+
+    def stats(self):
+        return {
+            'bytes': self.total_bytes(),
+            'max_bytes': self.max_bytes,
+            'high_watermark': self.high_watermark,
+            'low_watermark': self.low_watermark,
+            'free_disk_bytes': disk_free_bytes(),
+            'reserved_bytes': self.index.reserved_bytes(),
+            'pinned': len(self.refs),
+        }
+
+    def evict(self, extra_bytes=0):
+        """超过高水位或磁盘剩余空间不足时，按淘汰顺序删除未被引用的文件，直到低水位
+        
+        磁盘剩余空间要留出最低保留值、已预留的空间和extra_bytes。
+        引用计数只在本进程内有效；其他worker正在发送的文件被删除后，已打开的文件句柄仍可读完 (POSIX)。
+        """
+        if not self.evict_lock.acquire(blocking=False):
+            return 0
+        try:
+            total = self.index.total_bytes()
+            shortage = self.min_free_bytes + self.index.reserved_bytes() + extra_bytes - disk_free_bytes()
+            if total <= self.max_bytes * self.high_watermark and shortage <= 0:
+                return 0
+            target = min(self.max_bytes * self.low_watermark, total - max(shortage, 0))
+            freed = 0
+            for entry in self.index.eviction_order(CACHE_HIT_BONUS, CACHE_HIT_CAP):
+                if total <= target:
+                    break
+                if self.is_pinned(entry['path']):
+                    continue
+                self.index.delete(entry['video_id'], entry['format_type'])
+                with self.lock:
+                    self.hashes.pop(entry['path'], None)
+                total -= entry['size']
+                freed += entry['size']
+                try:
+                    remove_artifact(entry['path'])
+                    print(f"缓存淘汰: {entry['path']}")
+                except OSError as e:
+                    print(f"Cache evict error: {e}")
+            if freed:
+                with self.space_freed:
+                    self.space_freed.notify_all()
+            return freed
+        finally:
+            self.evict_lock.release()
+
+def disk_free_bytes():
+    try:
+        return shutil.disk_usage(TEMP_DIR).free
+    except OSError:
+        return 0
+
+conversion_cache = ConversionCache(
+    ArtifactIndex(os.path.join(DATA_DIR, 'artifacts.db')),
+    CACHE_MAX_BYTES, CACHE_HIGH_WATERMARK, CACHE_LOW_WATERMARK, CACHE_MIN_FREE_BYTES
+)
+
+class DiskLedger:
+    """磁盘空间预留账本: 任务下载前按估算大小预留，同一主机的所有worker共享 (记录在索引数据库中)"""
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def available_bytes(self):
+        return disk_free_bytes() - self.cache.min_free_bytes
+
+    def capacity_bytes(self):
+        """淘汰全部缓存后最多可用的空间"""
+        return self.available_bytes() + self.cache.total_bytes()
+
+    def reserve(self, task_id, nbytes):
+        """预留空间，不够时先淘汰缓存；仍然不够返回False (不等待)"""
+        while True:
+            self.purge()
+            if self.cache.index.reserve(task_id, nbytes, self.available_bytes()):
+                return True
+            if not self.cache.evict(nbytes):
+                return False
+
+    def update(self, task_id, nbytes):
+        self.cache.index.update_reservation(task_id, nbytes)
+
+    def release(self, task_id):
+        self.cache.index.release_reservation(task_id)
+        with self.cache.space_freed:
+            self.cache.space_freed.notify_all()
+
+    def purge(self):
+        """释放已经退出的worker留下的预留"""
+        for reservation in self.cache.index.reservations():
+            if owner_is_gone(reservation):
+                self.cache.index.release_reservation(reservation['task_id'])
+
+disk_ledger = DiskLedger(conversion_cache)
+
+# 转换结果按视频分目录存放: TEMP_DIR/ab/cd/<视频ID>/<格式>.<扩展名>，每个目录里的文件数很少
+def artifact_dir(video_id):
+    shard = hashlib.md5(video_id.encode()).hexdigest()
+    directory = os.path.join(TEMP_DIR, shard[:2], shard[2:4], video_id)
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+def artifact_path(video_id, format_type):
+    return os.path.join(artifact_dir(video_id), f"{format_type}.{SUPPORTED_FORMATS[format_type][0]}")
+
+def staging_path(final_path, token):
+    """同目录下的临时文件名 (隐藏文件，保留扩展名供ffmpeg识别格式)"""
+    directory, name = os.path.split(final_path)
+    base, ext = os.path.splitext(name)
+    return os.path.join(directory, f".{base}.{token}{ext}")
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def sidecar_path(path):
+    return path + '.json'
+
+def read_sidecar(path):
+    """文件旁边记录的大小和哈希，大小对不上时视为无效"""
+    try:
+        with open(sidecar_path(path)) as f:
+            meta = json.load(f)
+        return meta if meta.get('size') == os.path.getsize(path) else None
+    except (OSError, ValueError):
+        return None
+
+def publish_artifact(temp_path, final_path):
+    """先写sidecar再原子rename，读者看到的文件一定是完整的"""
+    meta = {'size': os.path.getsize(temp_path), 'sha256': file_sha256(temp_path), 'created_at': time.time()}
+    fd, meta_temp = tempfile.mkstemp(dir=os.path.dirname(final_path), prefix='.', suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(meta, f)
+    os.replace(meta_temp, sidecar_path(final_path))
+    os.replace(temp_path, final_path)
+    return meta
+
+def remove_artifact(path):
+    """删除文件和sidecar，视频目录空了就一起删除"""
+    for target in (path, sidecar_path(path)):
+        try:
+            os.remove(target)
+        except FileNotFoundError:
+            pass
+    if os.path.dirname(path) != TEMP_DIR:
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+
+# 进行中的下载: (视频ID, 格式) -> 主任务
+inflight = {}
+inflight_lock = threading.Lock()
+
+class WorkerPool:
+    """固定大小的线程池，带有界等待队列"""
+
+    def __init__(self, name, workers, queue_size):
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self.pending = deque()
+        self.active = 0
+        self.cond = threading.Condition()
+        self.pid = None
+
+    def _ensure_workers(self):
+        """在提交任务的进程中启动线程 (gunicorn --preload 时fork前启动的线程不会带到worker)"""
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.active = 0
+            for i in range(self.workers):
+                threading.Thread(target=self._worker, name=f'{self.name}-{i}', daemon=True).start()
+
+    def submit(self, key, fn, *args, force=False):
+        """加入队列，队列已满时返回False；force为True时不受队列长度限制 (恢复的任务)"""
+        with self.cond:
+            if not force and self.queue_size is not None and len(self.pending) >= self.queue_size:
+                return False
+            self._ensure_workers()
+            self.pending.append((key, fn, args))
+            self.cond.notify()
+            return True
+
+    def position(self, key):
+        """返回排队位置 (从1开始)，不在队列中返回None"""
+        with self.cond:
+            for index, item in enumerate(self.pending):
+                if item[0] == key:
+                    return index + 1
+        return None
+
+    def stats(self):
+        with self.cond:
+            return {
+                'workers': self.workers,
+                'active': self.active,
+                'queued': len(self.pending),
+                'queue_size': self.queue_size,
+            }
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                key, fn, args = self.pending.popleft()
+                self.active += 1
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"{self.name} worker error: {e}")
+            finally:
+                with self.cond:
+                    self.active -= 1
+
+# 下载线程池 (网络I/O) 负责准入控制，转码线程池 (CPU) 不限队列长度
+conversion_pool = WorkerPool('convert', CONVERT_WORKERS, CONVERT_QUEUE_SIZE)
+transcode_pool = WorkerPool('transcode', TRANSCODE_WORKERS, None)
+
+# yt-dlp公共参数
+YDL_BASE_OPTS = {
+    'socket_timeout': 60,
+    'retries': 3,
+    'nocheckcertificate': True,
+    'http_headers': {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+    },
+}
+
+# YoutubeDL实例的配置档位: 提取信息、下载音频、下载视频
+YDL_PROFILES = {
+    'info': dict(YDL_BASE_OPTS, **{
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': False,
+        'writeinfojson': False,
+        'writethumbnail': False,
+        'writesubtitles': False,
+        'writeautomaticsub': False,
+    }),
+    'playlist': dict(YDL_BASE_OPTS, **{
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': 'in_playlist',
+        'playlistend': BATCH_MAX_ITEMS,
+    }),
+    'audio': dict(YDL_BASE_OPTS, **{
+        'format': 'bestaudio/best',
+        'outtmpl': os.path.join(TEMP_DIR, '%(id)s.%(ext)s'),
+        'socket_timeout': 120,
+        'quiet': False,
+        'no_warnings': False,
+        'ignoreerrors': False,
+    }),
+    'video': dict(YDL_BASE_OPTS, **{
+        'format': 'best[height<=720]/best',
+        'outtmpl': os.path.join(TEMP_DIR, '%(id)s.%(ext)s'),
+        'socket_timeout': 120,
+        'quiet': False,
+        'no_warnings': False,
+        'ignoreerrors': False,
+    }),
+}
+
+class PooledYoutubeDL:
+    """池中的YoutubeDL实例，进度回调在每次借出时设置"""
+
+    def __init__(self, ydl):
+        self.ydl = ydl
+        self.progress_hook = None
+        ydl.add_progress_hook(self._on_progress)
+
+    def _on_progress(self, d):
+        if self.progress_hook is not None:
+            self.progress_hook(d)
+
+class YoutubeDLPool:
+    """按配置档位复用YoutubeDL实例，省去每次请求加载提取器和建立HTTP连接的开销
+    
+    实例属于创建它的进程，fork之后的worker会重新创建，不共享父进程的连接。
+    """
+
+    def __init__(self, profiles, size):
+        self.profiles = profiles
+        self.size = size
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def _create(self, profile):
+        import yt_dlp
+        return PooledYoutubeDL(yt_dlp.YoutubeDL(copy.deepcopy(self.profiles[profile])))
+
+    def _take(self, profile):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.idle = {}
+                self.pid = os.getpid()
+            idle = self.idle.setdefault(profile, [])
+            return idle.pop() if idle else None
+
+    def _give_back(self, profile, pooled):
+        with self.lock:
+            idle = self.idle.setdefault(profile, [])
+            if self.pid == os.getpid() and len(idle) < self.size:
+                idle.append(pooled)
+                return
+        pooled.ydl.close()
+
+    @contextmanager
+    def checkout(self, profile, format=None, outtmpl=None, progress_hook=None):
+        """借出一个实例，可以为这次使用指定格式、输出模板和进度回调"""
+        pooled = self._take(profile) or self._create(profile)
+        ydl = pooled.ydl
+        defaults = self.profiles[profile]
+        selector = format or defaults.get('format')
+        if selector and ydl.params.get('format') != selector:
+            ydl.params['format'] = selector
+            ydl.format_selector = ydl.build_format_selector(selector)
+        if 'outtmpl' in defaults or outtmpl:
+            ydl.params['outtmpl']['default'] = outtmpl or defaults['outtmpl']
+        pooled.progress_hook = progress_hook
+        try:
+            yield ydl
+        finally:
+            pooled.progress_hook = None
+            self._give_back(profile, pooled)
+
+    def warm(self):
+        """预先创建实例并加载YouTube提取器"""
+        for profile in self.profiles:
+            created = [self._create(profile) for i in range(self.size)]
+            if profile == 'info' and created:
+                created[0].ydl.get_info_extractor('Youtube')
+            for pooled in created:
+                self._give_back(profile, pooled)
+
+ydl_pool = YoutubeDLPool(YDL_PROFILES, CONVERT_WORKERS)
+
+# 支持的输出格式: 格式名 -> (类型, 码率kbps / 视频高度)
+SUPPORTED_FORMATS = {
+    'mp3_128': ('mp3', 128),
+    'mp3_256': ('mp3', 256),
+    'm4a_original': ('m4a', None),
+    'mp4_360': ('mp4', 360),
+    'mp4_720': ('mp4', 720),
+}
+
+# 音频类输出共用同一个音频源
+AUDIO_KINDS = ('mp3', 'm4a')
+
+MIME_TYPES = {
+    'mp3': 'audio/mpeg',
+    'm4a': 'audio/mp4',
+    'mp4': 'video/mp4',
+}
+
+# 未指定formats时生成的格式
+DEFAULT_FORMATS = ('mp3_256', 'mp4_720')
+
+def parse_formats(requested):
+    """校验请求的格式列表，返回去重排序后的元组"""
+    if not requested:
+        return DEFAULT_FORMATS
+    if isinstance(requested, str):
+        requested = [requested]
+    if not isinstance(requested, list) or not all(isinstance(fmt, str) for fmt in requested):
+        raise ValueError('formats必须是格式名或格式名列表')
+    unknown = [fmt for fmt in requested if fmt not in SUPPORTED_FORMATS]
+    if unknown:
+        raise ValueError(f"不支持的格式: {', '.join(map(str, unknown))}")
+    return tuple(sorted(set(requested)))
+
+def plan_downloads(formats, stream_formats=None, duration=0):
+    """每个不同的源流只下载一次，返回 [(源类型, yt-dlp格式, 由它生成的输出格式)]
+    
+    同时需要音频和视频时比较两种方案: 音频流 + 视频流分开下载，或者只下载视频流、
+    从它的音轨提取音频。视频格式在两种方案中相同 (和单独请求视频时一样)；提取方案
+    只在视频流音轨的码率不低于要求的码率时可选，在可选的方案中选择传输字节更少的。
+    """
+    plan = []
+    audio_outputs = [fmt for fmt in formats if SUPPORTED_FORMATS[fmt][0] in AUDIO_KINDS]
+    video_formats = [fmt for fmt in formats if SUPPORTED_FORMATS[fmt][0] == 'mp4']
+    audio_selector = 'bestaudio[ext=m4a]/bestaudio/best' if 'm4a_original' in audio_outputs else 'bestaudio/best'
+    
+    extract_from = None
+    if audio_outputs and video_formats and stream_formats:
+        candidate = max(video_formats, key=lambda fmt: SUPPORTED_FORMATS[fmt][1])
+        video_stream = select_stream(stream_formats, SUPPORTED_FORMATS[candidate][1])
+        audio_stream = select_audio(stream_formats, audio_selector)
+        video_size = stream_size(video_stream, duration)
+        audio_size = stream_size(audio_stream, duration)
+        # 大小未知时无法比较，保持分开下载
+        options = []
+        if video_size is not None and audio_size is not None:
+            options.append((video_size + audio_size, None))
+            if has_audio(video_stream) and \
+                    (video_stream.get('abr') or 0) >= required_audio_bitrate(audio_outputs, audio_stream):
+                options.append((video_size, candidate))
+        if options:
+            size, extract_from = min(options, key=lambda option: option[0])
+            if extract_from is not None:
+                print(f"从视频提取音频，少下载 {audio_size // 1024} KB")
+    
+    if audio_outputs and extract_from is None:
+        # 需要M4A时优先下载AAC音频，便于直接复制
+        plan.append(('audio', audio_selector, audio_outputs))
+    for fmt in video_formats:
+        outputs = [fmt] + (audio_outputs if fmt == extract_from else [])
+        plan.append(('video', video_selector(SUPPORTED_FORMATS[fmt][1]), outputs))
+    return plan
+
+def video_selector(height):
+    """视频格式的yt-dlp选择器，不论是否同时提取音频都使用同一个"""
+    return f'best[height<={height}]/best'
+
+def required_audio_bitrate(audio_outputs, audio_stream):
+    """音频输出需要的源码率 (kbps): MP3取最高的目标码率，M4A原音质取音频流的码率"""
+    bitrates = [SUPPORTED_FORMATS[fmt][1] for fmt in audio_outputs if SUPPORTED_FORMATS[fmt][0] == 'mp3']
+    if 'm4a_original' in audio_outputs:
+        bitrates.append((audio_stream or {}).get('abr') or 0)
+    return max(bitrates, default=0)
+
+def select_stream(stream_formats, height):
+    """近似yt-dlp的格式选择: height为None时选bestaudio，否则选不超过height的best"""
+    if height is None:
+        candidates = [f for f in stream_formats if f.get('vcodec') == 'none' and f.get('acodec') != 'none']
+        key = lambda f: f.get('abr') or f.get('tbr') or 0
+    else:
+        candidates = [f for f in stream_formats
+                      if f.get('vcodec') != 'none' and f.get('acodec') != 'none'
+                      and (f.get('height') or 0) <= height]
+        key = lambda f: (f.get('height') or 0, f.get('tbr') or 0)
+    return max(candidates, key=key) if candidates else None
+
+def select_audio(stream_formats, selector):
+    """近似音频源的选择器: bestaudio[ext=m4a]优先时先在M4A格式中选"""
+    if selector.startswith('bestaudio[ext=m4a]'):
+        m4a_stream = select_stream([f for f in stream_formats if f.get('ext') == 'm4a'], None)
+        if m4a_stream is not None:
+            return m4a_stream
+    return select_stream(stream_formats, None)
+
+def stream_size(stream, duration):
+    """格式的字节数，未知时按码率估算，无法估算返回None"""
+    if stream is None:
+        return None
+    size = stream.get('filesize') or stream.get('filesize_approx')
+    if not size and stream.get('tbr') and duration:
+        size = int(stream['tbr'] * duration * 1000 / 8)
+    return size or None
+
+def has_audio(stream):
+    return stream is not None and stream.get('acodec') not in (None, 'none')
+
+def summarize_formats(info):
+    """只保留规划下载需要的格式字段"""
+    keys = ('format_id', 'ext', 'vcodec', 'acodec', 'height', 'abr', 'tbr', 'filesize', 'filesize_approx',
+            'url', 'http_headers')
+    return [{key: f.get(key) for key in keys} for f in info.get('formats') or []]
+
+def attach_file(task, format_type, entry):
+    """把缓存中的文件登记到任务上"""
+    task.files = task.files or {}
+    task.files[format_type] = {
+        'filename': entry['filename'],
+        'path': entry['path'],
+        'size': entry['size'],
+        'download_url': f'/api/download/{task.task_id}/{format_type}'
+    }
+    task.notify_changed()
 
 @app.route('/')
 def index():
@@ -67,11 +1272,22 @@ def health_check():
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
         'message': 'YT2MP3 Enhanced API is running',
-        'active_tasks': len(tasks)
+        'active_tasks': sum(1 for task in list(tasks.values()) if task.finished_at is None),
+        'cached_tasks': len(tasks),
+        'stored_tasks': task_store.count_by_status(),
+        'pool': conversion_pool.stats(),
+        'transcode_pool': transcode_pool.stats(),
+        'cache': conversion_cache.stats()
     })
 
 @app.route('/debug')
 def debug_info():
+    # 只显示未结束的任务和最近结束的几个任务
+    snapshot = list(tasks.values())
+    active = [task for task in snapshot if task.finished_at is None]
+    recent = sorted((task for task in snapshot if task.finished_at is not None),
+                    key=lambda task: task.finished_at, reverse=True)[:DEBUG_RECENT_TASKS]
+    
     debug_html = '''
     <!DOCTYPE html>
     <html>
@@ -85,13 +1301,13 @@ def debug_info():
     </head>
     <body>
         <h1>调试信息</h1>
-        <h2>活跃任务 (''' + str(len(tasks)) + ''')</h2>
+        <h2>活跃任务 (''' + str(len(active)) + ''')</h2>
     '''
     
-    for task_id, task in tasks.items():
+    for task in active + recent:
         debug_html += f'''
         <div class="task">
-            <h3>任务 ID: {task_id}</h3>
+            <h3>任务 ID: {task.task_id}</h3>
             <p><strong>状态:</strong> {task.status}</p>
             <p><strong>进度:</strong> {task.progress}%</p>
             <p><strong>URL:</strong> {task.url}</p>
@@ -102,7 +1318,7 @@ def debug_info():
         </div>
         '''
     
-    if not tasks:
+    if not active:
         debug_html += '<p>暂无活跃任务</p>'
     
     debug_html += '''
@@ -133,37 +1349,11 @@ def get_video_info():
         if not url:
             return jsonify({'error': 'URL is required'}), 400
         
-        # 尝试使用yt-dlp获取真实信息
+        # 尝试使用yt-dlp获取真实信息 (与转换共用缓存)
         try:
-            import yt_dlp
-            
-            ydl_opts = {
-                'quiet': True,
-                'no_warnings': True,
-                'no_proxy': True,
-                'socket_timeout': 30,
-                'retries': 2,
-                'nocheckcertificate': True,
-                'http_headers': {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-                }
-            }
-            
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-                
-                video_info = {
-                    'id': info.get('id', 'unknown'),
-                    'title': info.get('title', 'Unknown Title'),
-                    'duration': info.get('duration', 0),
-                    'duration_string': info.get('duration_string', 'Unknown'),
-                    'thumbnail': info.get('thumbnail', ''),
-                    'uploader': info.get('uploader', 'Unknown'),
-                    'view_count': info.get('view_count', 0),
-                    'upload_date': info.get('upload_date', '')
-                }
-                
-                return jsonify({'success': True, 'data': video_info})
+            video_info = fetch_video_info(url)
+            video_info.pop('formats', None)
+            return jsonify({'success': True, 'data': video_info})
                 
         except ImportError:
             # 如果yt-dlp不可用，返回模拟信息
@@ -174,7 +1364,7 @@ def get_video_info():
             pass
         
         # 降级到模拟信息
-        video_id = url.split('v=')[-1][:11] if 'v=' in url else 'demo123'
+        video_id = canonical_video_id(url) or 'demo123'
         video_info = {
             'id': video_id,
             'title': f'YouTube视频 - {video_id}',
@@ -205,23 +1395,293 @@ def start_conversion():
         if not url:
             return jsonify({'error': 'URL is required'}), 400
         
+        try:
+            formats = parse_formats(data.get('formats'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # 视频信息已在缓存中时按这个任务的估算大小检查，淘汰全部缓存也放不下的直接拒绝
+        needed = estimate_request_bytes(url, formats)
+        if needed is not None and needed > disk_ledger.capacity_bytes():
+            return jsonify({'error': f'磁盘空间不足，无法处理这个视频 (需要约 {needed // (1024 * 1024)} MB)'}), 507
+        
         # 生成任务ID
         task_id = hashlib.md5(f"{url}_{datetime.now().isoformat()}".encode()).hexdigest()
         
         # 创建任务
-        task = Task(task_id, url)
+        task = Task(task_id, url, formats)
         tasks[task_id] = task
         
-        # 在后台开始转换
-        threading.Thread(target=perform_conversion, args=(task_id,), daemon=True).start()
+        # 交给转换线程池，队列满或磁盘已满 (且没有可淘汰的缓存) 时拒绝
+        if disk_ledger.capacity_bytes() <= 0 or not conversion_pool.submit(task_id, perform_conversion, task_id):
+            del tasks[task_id]
+            response = jsonify({'error': '服务器繁忙，请稍后重试', 'retry_after': RETRY_AFTER_SECONDS})
+            response.headers['Retry-After'] = str(RETRY_AFTER_SECONDS)
+            return response, 503
+        
+        save_task(task)
+        
+        return jsonify({
+            'success': True,
+            'task_id': task_id,
+            'queue_position': conversion_pool.position(task_id)
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/convert/batch', methods=['POST', 'OPTIONS'])
+def start_batch_conversion():
+    """批量转换: urls为视频链接列表，或url为播放列表链接"""
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'ok'})
+    
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'error': 'Invalid JSON data'}), 400
+        
+        try:
+            formats = parse_formats(data.get('formats'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        return jsonify({'success': True, 'task_id': task_id})
+        urls = data.get('urls')
+        source_url = data.get('url', '')
+        if urls is not None and not isinstance(urls, list):
+            return jsonify({'error': 'urls must be a list'}), 400
+        if not urls and not source_url:
+            return jsonify({'error': 'URL is required'}), 400
+        
+        if not urls:
+            try:
+                urls = expand_playlist(source_url)
+            except Exception as e:
+                return jsonify({'error': f'展开播放列表失败: {str(e)}'}), 400
+        urls = unique_urls(urls)
+        if not urls:
+            return jsonify({'error': '没有可转换的视频'}), 400
+        if len(urls) > BATCH_MAX_ITEMS:
+            return jsonify({'error': f'一次最多转换{BATCH_MAX_ITEMS}个视频'}), 400
+        
+        batch_id = hashlib.md5(f"batch_{source_url or urls[0]}_{datetime.now().isoformat()}".encode()).hexdigest()
+        task_ids = []
+        for index, url in enumerate(urls):
+            task_id = hashlib.md5(f"{batch_id}_{index}_{url}".encode()).hexdigest()
+            task = Task(task_id, url, formats)
+            tasks[task_id] = task
+            save_task(task)
+            task_ids.append(task_id)
+        
+        batch = {
+            'task_id': batch_id,
+            'kind': 'batch',
+            'status': 'batch',
+            'url': source_url,
+            'formats': list(formats),
+            'task_ids': task_ids,
+            'created_at': datetime.now().isoformat(),
+            'updated_at': time.time(),
+            'owner': worker_id(),
+        }
+        batches[batch_id] = batch
+        task_store.save(batch)
+        threading.Thread(target=run_batch, args=(batch_id,), daemon=True).start()
+        
+        return jsonify({
+            'success': True,
+            'batch_id': batch_id,
+            'task_ids': task_ids,
+            'total': len(task_ids)
+        })
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def expand_playlist(url):
+    """用extract_flat展开播放列表 (不逐个解析视频)，单个视频返回它自己"""
+    with ydl_pool.checkout('playlist') as ydl:
+        info = ydl.extract_info(url, download=False)
+    if info.get('_type') not in ('playlist', 'multi_video'):
+        return [info.get('webpage_url') or url]
+    urls = []
+    for entry in info.get('entries') or []:
+        # 不可用的视频展开后是None
+        if entry and (entry.get('url') or entry.get('webpage_url')):
+            urls.append(entry.get('url') or entry.get('webpage_url'))
+    return urls
+
+def unique_urls(urls):
+    """去掉空链接和指向同一视频的重复链接，保持顺序"""
+    seen = set()
+    result = []
+    for url in urls:
+        if not isinstance(url, str) or not url.strip():
+            continue
+        key = metadata_key(url)
+        if key not in seen:
+            seen.add(key)
+            result.append(url.strip())
+    return result
+
+def run_batch(batch_id):
+    """按批次并发上限把任务依次交给转换线程池，转换线程池队列满时等待"""
+    pending = deque(batches[batch_id]['task_ids'])
+    running = []
+    while pending or running:
+        running = [task for task in running if task.status not in ('completed', 'error')]
+        while pending and len(running) < BATCH_CONCURRENCY:
+            task = tasks.get(pending[0])
+            if task is None:
+                pending.popleft()
+                continue
+            if not conversion_pool.submit(task.task_id, perform_conversion, task.task_id):
+                break
+            pending.popleft()
+            running.append(task)
+        time.sleep(STATUS_PUSH_INTERVAL)
+    # 之后从存储读取批量任务记录
+    batches.pop(batch_id, None)
+
+def find_batch(batch_id):
+    batch = batches.get(batch_id)
+    if batch is not None:
+        return batch
+    record = task_store.load(batch_id)
+    return record if record and record.get('kind') == 'batch' else None
+
+@app.route('/api/batch/<batch_id>', methods=['GET'])
+def get_batch_status(batch_id):
+    """批量任务的汇总状态"""
+    batch = find_batch(batch_id)
+    if batch is None:
+        return jsonify({'error': 'Batch not found'}), 404
+    
+    items = []
+    counts = {'pending': 0, 'processing': 0, 'completed': 0, 'error': 0}
+    progress = 0
+    for task_id in batch['task_ids']:
+        task = find_task(task_id)
+        if task is None:
+            continue
+        status = build_status(task)
+        counts[status['status']] = counts.get(status['status'], 0) + 1
+        progress += status['progress']
+        items.append({
+            'task_id': task_id,
+            'url': task.url,
+            'status': status['status'],
+            'progress': status['progress'],
+            'title': (task.video_info or {}).get('title'),
+            'error': status['error'],
+            'files': status.get('files', {}),
+        })
+    
+    if counts['pending'] + counts['processing']:
+        status = 'processing' if counts['processing'] + counts['completed'] + counts['error'] else 'pending'
+    else:
+        status = 'completed' if counts['completed'] else 'error'
+    
+    return jsonify({
+        'batch_id': batch_id,
+        'status': status,
+        'progress': progress // len(items) if items else 0,
+        'total': len(batch['task_ids']),
+        'counts': counts,
+        'tasks': items,
+        'zip_url': f'/api/batch/{batch_id}/zip'
+    })
+
+@app.route('/api/batch/<batch_id>/zip', methods=['GET'])
+def download_batch_zip(batch_id):
+    """把批量任务中已完成的文件打包成ZIP，边读边发送"""
+    batch = find_batch(batch_id)
+    if batch is None:
+        abort(404)
+    
+    entries = []
+    names = set()
+    for task_id in batch['task_ids']:
+        task = find_task(task_id)
+        if task is None or task.status != 'completed':
+            continue
+        for format_type, file_info in sorted((task.files or {}).items()):
+            if not os.path.exists(file_info.get('path', '')):
+                continue
+            name = unique_name(file_info['filename'], names)
+            entries.append((name, file_info['path']))
+    if not entries:
+        abort(404)
+    
+    return zip_response(entries, f'batch_{batch_id[:8]}.zip')
+
+def zip_response(entries, filename):
+    """以ZIP发送 [(ZIP中的文件名, 路径)]，发送期间文件不会被缓存淘汰"""
+    paths = [path for name, path in entries]
+    for path in paths:
+        conversion_cache.acquire(path)
+    
+    def release_all():
+        for path in paths:
+            conversion_cache.release(path)
+    
+    response = Response(ClosingIterator(stream_zip(entries), release_all), mimetype='application/zip')
+    response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(filename)}"
+    return response
+
+def unique_name(filename, names):
+    """ZIP中同名文件加上序号"""
+    base, ext = os.path.splitext(filename)
+    name = filename
+    index = 1
+    while name in names:
+        index += 1
+        name = f'{base} ({index}){ext}'
+    names.add(name)
+    return name
+
+class ZipStreamWriter:
+    """zipfile的输出目标: 没有seek，zipfile会改用数据描述符，写入的数据由生成器取走"""
+
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_zip(entries):
+    """按块生成不压缩的ZIP (音视频本身已压缩)，内存中只保留一个读取块"""
+    writer = ZipStreamWriter()
+    with zipfile.ZipFile(writer, 'w', zipfile.ZIP_STORED) as archive:
+        for name, path in entries:
+            info = zipfile.ZipInfo(name, date_time=time.localtime(os.path.getmtime(path))[:6])
+            info.file_size = os.path.getsize(path)
+            with open(path, 'rb') as source, archive.open(info, 'w') as target:
+                while True:
+                    chunk = source.read(STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    target.write(chunk)
+                    yield writer.drain()
+            yield writer.drain()
+    yield writer.drain()
+
 def perform_conversion(task_id):
-    """执行转换 - 真实下载YouTube视频"""
+    """下载阶段 - 获取视频信息并下载源文件，转码交给转码线程池"""
     task = tasks[task_id]
     
     try:
@@ -232,207 +1692,696 @@ def perform_conversion(task_id):
         try:
             import yt_dlp
             
+            # 离线就能确定视频ID时，在提取信息之前查缓存、合并到进行中的任务
+            if task.video_id and claim_formats(task, task.video_id):
+                return
+            
             # 先获取视频信息
             task.progress = 20
             video_info = get_real_video_info(task.url)
+            task.stream_formats = video_info.pop('formats', [])
             task.video_info = video_info
             
-            # 真实下载文件
-            task.progress = 40
-            download_real_files(task)
+            # 全部命中缓存或由其他任务生成时不需要下载
+            if claim_formats(task, video_info['id']):
+                return
             
-            task.status = 'completed'
-            task.progress = 100
+            try:
+                # 真实下载文件
+                jobs = download_real_files(task)
+            except Exception as e:
+                fail_task(task, f'下载失败: {str(e)}')
+                print(f"Download failed: {e}")
+                return
+            if jobs is None:
+                # 磁盘空间不够，释放线程，空间够用时由disk_wait_loop重新提交
+                return
+            
+            # 下载完成后记录检查点并排队转码，不占用下载线程
+            task.progress = 70
+            task.checkpoint = {'stage': 'transcode', 'jobs': jobs}
+            transcode_pool.submit(task_id, perform_transcode, task_id, jobs)
             
         except ImportError:
-            task.status = 'error'
             task.error = 'yt-dlp不可用，无法下载视频'
-            print("yt-dlp not available")
-        except Exception as e:
             task.status = 'error'
-            task.error = f'下载失败: {str(e)}'
-            print(f"Download failed: {e}")
+            print("yt-dlp not available")
         
     except Exception as e:
-        task.status = 'error'
-        task.error = f'转换失败: {str(e)}'
+        fail_task(task, f'转换失败: {str(e)}')
         print(f"Conversion error: {e}")
 
+def claim_formats(task, video_id):
+    """分配任务的格式: 缓存中已有的直接登记，其他任务正在生成的合并过去，其余登记为本任务生成
+    
+    每个 (视频ID, 格式) 同时只有一个任务下载和转码。本任务不需要下载时返回True。
+    重新提交的任务 (例如等待磁盘空间后) 再次调用时只处理还没分配的格式。
+    """
+    pending = [fmt for fmt in task.formats
+               if fmt not in task.files and fmt not in task.following and fmt not in task.produce]
+    hits = {}
+    for fmt in pending:
+        entry = conversion_cache.get(video_id, fmt)
+        if entry is not None:
+            hits[fmt] = entry
+    produce = []
+    with inflight_lock:
+        for fmt in pending:
+            if fmt in hits:
+                continue
+            key = (video_id, fmt)
+            leader = inflight.get(key)
+            if leader is not None and leader is not task:
+                task.following[fmt] = leader
+                if task not in leader.followers:
+                    leader.followers.append(task)
+            else:
+                inflight[key] = task
+                task.inflight_keys.append(key)
+                produce.append(fmt)
+        task.produce = task.produce + tuple(produce)
+        following = dict(task.following)
+    
+    for fmt, entry in hits.items():
+        attach_file(task, fmt, entry)
+    if hits:
+        print(f"缓存命中: {video_id} {sorted(hits)}")
+    if task.produce:
+        return False
+    if following:
+        print(f"合并到进行中的任务: {sorted(set(leader.task_id for leader in following.values()))}")
+        task.leader = next(iter(following.values()))
+        return True
+    
+    # 全部命中缓存
+    if task.video_info is None:
+        # 没有提取信息: 使用缓存的视频信息，没有就从缓存文件名取标题
+        entry = metadata_cache.get(metadata_key(task.url))
+        if entry is not None and 'info' in entry:
+            task.video_info = {key: value for key, value in entry['info'].items() if key != 'formats'}
+        else:
+            filename = next(iter(hits.values()))['filename']
+            task.video_info = {'id': video_id, 'title': os.path.splitext(filename)[0]}
+    complete_task(task)
+    return True
+
+def perform_transcode(task_id, jobs):
+    """转码阶段 - 在CPU线程池中运行ffmpeg"""
+    task = tasks[task_id]
+    
+    try:
+        for index, (source_path, outputs) in enumerate(jobs):
+            convert_source(source_path, outputs, transcode_progress_hook(task, index, len(jobs)))
+            for format_type, output_path, filename in outputs:
+                attach_file(task, format_type, {
+                    'filename': filename,
+                    'path': output_path,
+                    'size': os.path.getsize(output_path)
+                })
+                print(f"输出文件生成成功: {output_path}")
+            # 源文件本身就是输出时保留
+            if all(output_path != source_path for _, output_path, _ in outputs) and os.path.exists(source_path):
+                os.remove(source_path)
+            # 重启后只需转码剩下的源文件
+            task.checkpoint = {'stage': 'transcode', 'jobs': jobs[index + 1:]}
+        complete_task(task)
+    except Exception as e:
+        fail_task(task, f'转码失败: {str(e)}')
+        print(f"Transcode failed: {e}")
+
+def transcode_progress_hook(task, index, count):
+    """ffmpeg进度回调: 转码占总进度的70%-100%"""
+    duration = (task.video_info or {}).get('duration') or 0
+    
+    def hook(out_time, speed):
+        fraction = min(out_time / duration, 1) if duration else 0
+        task.stages = dict(task.stages, transcode={
+            'out_time': round(out_time, 1),
+            'duration': duration,
+            'speed': speed,
+            'eta': round((duration - out_time) / speed, 1) if speed and duration > out_time else None,
+            'source': index + 1,
+            'sources': count,
+        })
+        task.progress = min(99, 70 + int(30 * (index + fraction) / count))
+    return hook
+
+def convert_source(source_path, outputs, on_progress=None):
+    """从一个源文件生成所有输出，兼容的流直接复制，其余一次解码后编码
+    
+    ffmpeg写到临时文件，全部成功后再逐个原子发布。
+    """
+    codecs = probe_codecs(source_path)
+    token = os.urandom(6).hex()
+    staged = []
+    for format_type, output_path, filename in outputs:
+        # 恢复的任务: 已经发布的输出 (文件和sidecar都在) 不再重新生成
+        if output_path == source_path or read_sidecar(output_path) is not None:
+            continue
+        kind, quality = SUPPORTED_FORMATS[format_type]
+        staged.append((staging_path(output_path, token), output_path, output_args(kind, quality, codecs)))
+    if not staged:
+        return
+    try:
+        run_ffmpeg(source_path, [(temp_path, args) for temp_path, output_path, args in staged], on_progress)
+        for temp_path, output_path, args in staged:
+            publish_artifact(temp_path, output_path)
+    finally:
+        for temp_path, output_path, args in staged:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+def output_args(kind, quality, codecs):
+    """单个输出的ffmpeg参数，源编码已兼容时使用 -c copy 跳过重新编码"""
+    audio = codecs.get('audio')
+    if kind == 'mp3':
+        # 源已经是不高于目标码率的MP3时直接复制
+        bitrate = codecs.get('audio_bitrate') or 0
+        if audio == 'mp3' and 0 < bitrate <= quality * 1000:
+            codec = ['-c:a', 'copy']
+        else:
+            codec = ['-c:a', 'libmp3lame', '-b:a', f'{quality}k']
+        return ['-map', '0:a:0', '-vn'] + codec
+    if kind == 'm4a':
+        codec = ['-c:a', 'copy'] if audio == 'aac' else ['-c:a', 'aac', '-b:a', '192k']
+        return ['-map', '0:a:0', '-vn'] + codec
+    # mp4: H.264/AAC直接封装，其他编码才转码
+    video_codec = ['-c:v', 'copy'] if codecs.get('video') == 'h264' else ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23']
+    audio_codec = ['-c:a', 'copy'] if audio in ('aac', None) else ['-c:a', 'aac', '-b:a', '128k']
+    return ['-map', '0:v:0', '-map', '0:a:0?'] + video_codec + audio_codec + ['-movflags', '+faststart']
+
+def is_compatible_mp4(path):
+    """MP4中的编码可以直接提供下载 (与output_args中 -c copy 的条件相同)"""
+    codecs = probe_codecs(path)
+    return codecs.get('video') == 'h264' and codecs.get('audio') in ('aac', None)
+
+def probe_codecs(source_path):
+    """用ffprobe读取源文件的音视频编码，失败时返回空字典 (全部重新编码)"""
+    command = [
+        'ffprobe', '-v', 'error',
+        '-show_entries', 'stream=codec_type,codec_name,bit_rate',
+        '-of', 'json', source_path
+    ]
+    try:
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        streams = json.loads(result.stdout or b'{}').get('streams', [])
+    except (OSError, ValueError) as e:
+        print(f"ffprobe error: {e}")
+        return {}
+    codecs = {}
+    for stream in streams:
+        codec_type = stream.get('codec_type')
+        if codec_type in ('audio', 'video') and codec_type not in codecs:
+            codecs[codec_type] = stream.get('codec_name')
+            if codec_type == 'audio' and str(stream.get('bit_rate', '')).isdigit():
+                codecs['audio_bitrate'] = int(stream['bit_rate'])
+    return codecs
+
+def run_ffmpeg(source_path, outputs, on_progress=None):
+    """一次ffmpeg调用生成多个输出，outputs为 [(输出路径, 参数列表)]，源只解码一次
+    
+    通过 -progress 读取已转码的时长和速度，回调 on_progress(秒, 倍速)。
+    """
+    command = ['ffmpeg', '-y', '-nostdin', '-loglevel', 'error', '-nostats', '-progress', 'pipe:1', '-i', source_path]
+    for output_path, args in outputs:
+        command += args + [output_path]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    errors = []
+    out_time = 0.0
+    for raw_line in process.stdout:
+        line = raw_line.decode('utf-8', 'replace').strip()
+        key, sep, value = line.partition('=')
+        if not sep or ' ' in key:
+            if line:
+                errors.append(line)
+        elif key == 'out_time_us' and value.isdigit():
+            out_time = int(value) / 1000000
+        elif key == 'speed' and on_progress:
+            try:
+                speed = float(value.rstrip('x'))
+            except ValueError:
+                speed = None
+            on_progress(out_time, speed)
+    if process.wait() != 0:
+        raise Exception('\n'.join(errors) or 'ffmpeg失败')
+
+def complete_task(task):
+    """本任务生成的格式完成: 写入缓存，通知等待这些格式的任务；还在等待其他任务时暂不结束"""
+    for fmt, file_info in task.files.items():
+        conversion_cache.put(task.video_info['id'], fmt, file_info['path'], file_info['filename'])
+    task.checkpoint = None
+    disk_ledger.release(task.task_id)
+    task.produce = ()
+    release_inflight(task)
+    settle_task(task)
+
+def fail_task(task, error):
+    # 先写错误信息再改状态，SSE读到error状态时error已经就绪
+    task.checkpoint = None
+    task.error = error
+    task.status = 'error'
+    disk_ledger.release(task.task_id)
+    task.produce = ()
+    with inflight_lock:
+        for leader in set(task.following.values()):
+            if task in leader.followers:
+                leader.followers.remove(task)
+        task.following = {}
+    release_inflight(task)
+
+def release_inflight(task):
+    """注销本任务生成的格式，把结果交给合并进来的任务"""
+    with inflight_lock:
+        for key in task.inflight_keys:
+            if inflight.get(key) is task:
+                del inflight[key]
+        task.inflight_keys = []
+        followers = task.followers
+        task.followers = []
+    for follower in followers:
+        finish_following(follower, task)
+
+def finish_following(follower, leader):
+    """主任务结束: 把它生成的格式登记到合并进来的任务上"""
+    with inflight_lock:
+        formats = [fmt for fmt, source in follower.following.items() if source is leader]
+        for fmt in formats:
+            del follower.following[fmt]
+    if follower.video_info is None:
+        follower.video_info = leader.video_info
+    for fmt in formats:
+        if fmt in leader.files:
+            attach_file(follower, fmt, leader.files[fmt])
+    settle_task(follower, leader.error)
+
+def settle_task(task, error=None):
+    """自己生成的格式和等待的其他任务都结束后，有文件即完成，否则失败"""
+    # 在锁内判断并结束，两个主任务同时结束时只结束一次
+    with inflight_lock:
+        if task.status in Task.FINISHED_STATUSES or task.produce:
+            return
+        if task.following:
+            # 继续显示还在进行的任务的进度
+            task.leader = next(iter(task.following.values()))
+            return
+        task.leader = None
+        if task.files:
+            task.progress = 100
+            task.status = 'completed'
+        else:
+            task.error = task.error or error or '转换失败'
+            task.status = 'error'
+    disk_ledger.release(task.task_id)
+
 def get_real_video_info(url):
-    """获取真实的视频信息"""
+    """获取真实的视频信息 (含下载规划需要的格式列表)"""
+    return fetch_video_info(url)
+
+def fetch_video_info(url):
+    """提取视频信息，优先使用缓存；同一个视频同时只提取一次"""
+    key = metadata_key(url)
+    # 锁带有使用者计数，最后一个使用者离开时才删除，等待中的请求一直共用同一把锁
+    with metadata_locks_guard:
+        holder = metadata_locks.setdefault(key, {'lock': threading.Lock(), 'users': 0})
+        holder['users'] += 1
+    try:
+        with holder['lock']:
+            entry = metadata_cache.get(key)
+            if entry is None:
+                entry = extract_video_info(url, key)
+    finally:
+        with metadata_locks_guard:
+            holder['users'] -= 1
+            if holder['users'] == 0:
+                del metadata_locks[key]
+    
+    if 'error' in entry:
+        raise Exception(entry['error'])
+    # 调用方会修改返回值 (例如取走formats)，返回副本
+    return dict(entry['info'])
+
+def extract_video_info(url, key):
     import yt_dlp
     
-    ydl_opts = {
-        'quiet': True,
-        'no_warnings': True,
-        'socket_timeout': 60,
-        'retries': 3,
-        'nocheckcertificate': True,
-        'extract_flat': False,
-        'writeinfojson': False,
-        'writethumbnail': False,
-        'writesubtitles': False,
-        'writeautomaticsub': False,
-    }
+    try:
+        with ydl_pool.checkout('info') as ydl:
+            info = ydl.extract_info(canonical_url(url), download=False)
+            raw_info = ydl.sanitize_info(info)
+    except yt_dlp.utils.DownloadError as e:
+        # 视频不可用等提取失败的结果短时间缓存，避免重复请求YouTube
+        return metadata_cache.put_error(key, str(e))
     
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=False)
-        
-        return {
-            'id': info.get('id', 'unknown'),
-            'title': info.get('title', 'Unknown Title'),
-            'duration': info.get('duration', 0),
-            'duration_string': info.get('duration_string', 'Unknown'),
-            'thumbnail': info.get('thumbnail', ''),
-            'uploader': info.get('uploader', 'Unknown'),
-            'view_count': info.get('view_count', 0),
-            'upload_date': info.get('upload_date', '')
-        }
+    # 下载阶段直接使用完整的提取结果，去掉用不到的大字段
+    for field in RAW_INFO_DROP_FIELDS:
+        raw_info.pop(field, None)
+    
+    return metadata_cache.put(key, raw_info, {
+        'id': info.get('id', 'unknown'),
+        'title': info.get('title', 'Unknown Title'),
+        'duration': info.get('duration', 0),
+        'duration_string': info.get('duration_string', 'Unknown'),
+        'thumbnail': info.get('thumbnail', ''),
+        'uploader': info.get('uploader', 'Unknown'),
+        'view_count': info.get('view_count', 0),
+        'upload_date': info.get('upload_date', ''),
+        'formats': summarize_formats(info)
+    })
+
+def fetch_raw_info(url):
+    """下载用的完整提取结果 (副本)，yt-dlp处理时会修改它"""
+    key = metadata_key(url)
+    entry = metadata_cache.get(key)
+    if entry is None or 'raw' not in entry:
+        fetch_video_info(url)
+        entry = metadata_cache.get(key)
+    if entry is None or 'raw' not in entry:
+        raise Exception((entry or {}).get('error') or '无法获取视频信息')
+    return copy.deepcopy(entry['raw'])
+
+def metadata_key(url):
+    """视频信息缓存的键: 能识别的YouTube链接用视频ID，其他链接用原URL"""
+    return canonical_video_id(url) or url.strip()
+
+# 各种YouTube链接形式中的视频ID
+YOUTUBE_ID_PATTERNS = [
+    re.compile(r'^(?:https?://)?(?:www\.|m\.|music\.)?youtube\.com/watch/?\?(?:.*&)?v=([A-Za-z0-9_-]{11})(?:[&#]|$)'),
+    re.compile(r'^(?:https?://)?(?:www\.|m\.|music\.)?youtube\.com/(?:shorts|embed|v|live|e)/([A-Za-z0-9_-]{11})(?:[/?&#]|$)'),
+    re.compile(r'^(?:https?://)?(?:www\.)?youtube-nocookie\.com/embed/([A-Za-z0-9_-]{11})(?:[/?&#]|$)'),
+    re.compile(r'^(?:https?://)?youtu\.be/([A-Za-z0-9_-]{11})(?:[/?&#]|$)'),
+]
+
+def lower_host(url):
+    """协议和主机名转成小写 (视频ID区分大小写，路径和参数保持不变)"""
+    has_scheme = '://' in url
+    try:
+        parts = urlsplit(url if has_scheme else '//' + url)
+    except ValueError:
+        return url
+    normalized = urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, parts.fragment))
+    return normalized if has_scheme else normalized[2:]
+
+def canonical_video_id(url):
+    """不访问网络，从YouTube链接中取出视频ID，无法识别时返回None"""
+    url = lower_host((url or '').strip())
+    for pattern in YOUTUBE_ID_PATTERNS:
+        match = pattern.match(url)
+        if match:
+            return match.group(1)
+    return None
+
+def canonical_url(url):
+    """能识别视频ID时换成标准的watch链接 (去掉播放列表、时间等参数)"""
+    video_id = canonical_video_id(url)
+    return f'https://www.youtube.com/watch?v={video_id}' if video_id else url
 
 def download_real_files(task):
-    """下载真实的音频和视频文件"""
+    """按下载计划下载源文件，返回需要转码的任务列表 [(源文件, [(格式, 输出路径, 文件名)])]；
+    磁盘空间暂时不够时返回None，任务进入磁盘等待队列"""
     import yt_dlp
     
     video_id = task.video_info['id']
-    safe_title = "".join(c for c in task.video_info['title'][:50] if c.isalnum() or c in (' ', '-', '_')).strip()
+    title = safe_title(task.video_info['title'])
     
-    print(f"开始下载: {task.video_info['title']}")
+    print(f"开始下载: {task.video_info['title']} {list(task.produce)}")
     
-    # 下载音频 (MP3)
-    task.progress = 50
-    mp3_filename = f"{video_id}_{safe_title}.mp3"
-    mp3_filepath = os.path.join(TEMP_DIR, mp3_filename)
+    duration = task.video_info.get('duration') or 0
+    plan = plan_downloads(task.produce, task.stream_formats, duration)
+    source_bytes, output_bytes = estimate_task_bytes(plan, task.stream_formats, duration)
+    if not reserve_disk_space(task, source_bytes + output_bytes):
+        return None
+    # 使用已经提取好的信息下载，不再重新提取
+    raw_info = fetch_raw_info(task.url)
+    jobs = []
+    errors = []
+    for index, (kind, selector, outputs) in enumerate(plan):
+        task.progress = 20 + 50 * index // len(plan)
+        # 源文件按任务命名，同一视频的不同任务不会写同一个.part文件
+        source_name = f"source.{task.task_id[:12]}.{kind if kind == 'audio' else outputs[0]}.%(ext)s"
+        
+        try:
+            with ydl_pool.checkout(kind, format=selector, outtmpl=os.path.join(artifact_dir(video_id), source_name),
+                                   progress_hook=download_progress_hook(task, index, len(plan))) as ydl:
+                result = ydl.process_ie_result(copy.deepcopy(raw_info), download=True)
+                filepath = downloaded_path(ydl, result)
+            if filepath is None:
+                raise Exception("未找到下载的文件")
+        except Exception as e:
+            print(f"{kind}下载出错: {e}")
+            errors.append(f"{kind}: {str(e)}")
+            continue
+        
+        # 视频源已经是H.264/AAC的MP4时直接发布为输出，不再经过ffmpeg
+        if kind == 'video':
+            target = artifact_path(video_id, outputs[0])
+            if os.path.splitext(filepath)[1] == os.path.splitext(target)[1] and is_compatible_mp4(filepath):
+                publish_artifact(filepath, target)
+                filepath = target
+        
+        # 源文件交给转码阶段生成所有输出
+        job_outputs = []
+        for fmt in outputs:
+            ext = SUPPORTED_FORMATS[fmt][0]
+            job_outputs.append((fmt, artifact_path(video_id, fmt), f"{title}.{ext}"))
+        jobs.append((filepath, job_outputs))
+        print(f"{kind}源文件下载成功: {filepath}")
     
-    ydl_opts_audio = {
-        'format': 'bestaudio/best',
-        'outtmpl': mp3_filepath.replace('.mp3', '.%(ext)s'),
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': '256',
-        }],
-        'quiet': False,
-        'no_warnings': False,
-        'socket_timeout': 120,
-        'retries': 3,
-        'nocheckcertificate': True,
-        'extract_flat': False,
-        'ignoreerrors': False,
-    }
+    # 部分格式失败不是致命错误，全部失败才报错
+    if not jobs:
+        raise Exception('; '.join(errors) or '文件下载失败')
     
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts_audio) as ydl:
-            ydl.download([task.url])
-            
-        # 查找下载的音频文件
-        audio_file_found = False
-        for file in os.listdir(TEMP_DIR):
-            if video_id in file and (file.endswith('.mp3') or file.endswith('.m4a') or file.endswith('.webm')):
-                actual_filepath = os.path.join(TEMP_DIR, file)
-                # 如果不是mp3，重命名为mp3
-                if not file.endswith('.mp3'):
-                    new_filepath = os.path.join(TEMP_DIR, f"{video_id}_{safe_title}.mp3")
-                    os.rename(actual_filepath, new_filepath)
-                    actual_filepath = new_filepath
-                
-                task.files = task.files or {}
-                task.files['mp3_256'] = {
-                    'filename': f"{safe_title}.mp3",
-                    'path': actual_filepath,
-                    'size': os.path.getsize(actual_filepath),
-                    'download_url': f'/api/download/{task.task_id}/mp3_256'
-                }
-                audio_file_found = True
-                print(f"音频文件下载成功: {actual_filepath}")
-                break
-                
-        if not audio_file_found:
-            raise Exception("音频文件下载失败")
-            
-    except Exception as e:
-        print(f"音频下载出错: {e}")
-        raise Exception(f"音频下载失败: {str(e)}")
+    # 源文件已经在磁盘上，只需继续为转码输出预留
+    disk_ledger.update(task.task_id, output_bytes)
     
-    # 下载视频 (MP4)
-    task.progress = 80
-    mp4_filename = f"{video_id}_{safe_title}.mp4"
-    mp4_filepath = os.path.join(TEMP_DIR, mp4_filename)
+    print(f"下载完成，待转码 {len(jobs)} 个源文件")
+    return jobs
+
+def estimate_request_bytes(url, formats):
+    """提交时估算任务需要的磁盘空间，视频信息不在缓存中时返回None"""
+    entry = metadata_cache.get(metadata_key(url))
+    if entry is None or 'info' not in entry:
+        return None
+    info = entry['info']
+    duration = info.get('duration') or 0
+    plan = plan_downloads(formats, info.get('formats'), duration)
+    return sum(estimate_task_bytes(plan, info.get('formats'), duration))
+
+def estimate_task_bytes(plan, stream_formats, duration):
+    """根据格式列表中的filesize/filesize_approx (或码率) 估算 (源文件字节数, 输出文件字节数)"""
+    source_bytes = 0
+    output_bytes = 0
+    for kind, selector, outputs in plan:
+        if kind == 'audio':
+            stream = select_audio(stream_formats or [], selector)
+        else:
+            stream = select_stream(stream_formats or [], SUPPORTED_FORMATS[outputs[0]][1])
+        size = stream_size(stream, duration) or 0
+        source_bytes += size
+        for fmt in outputs:
+            out_kind, quality = SUPPORTED_FORMATS[fmt]
+            if out_kind == 'mp3':
+                output_bytes += quality * 1000 // 8 * int(duration)
+            elif out_kind == 'mp4' or kind == 'audio':
+                # 直接复制的流大小不变
+                output_bytes += size
+            else:
+                output_bytes += 192 * 1000 // 8 * int(duration)
+    return int(source_bytes * DISK_ESTIMATE_MARGIN), int(output_bytes * DISK_ESTIMATE_MARGIN)
+
+# 等待磁盘空间的任务: 任务ID -> {needed, deadline, queued}，不占用转换线程池
+disk_waiters = OrderedDict()
+disk_waiters_lock = threading.Lock()
+
+def reserve_disk_space(task, needed):
+    """下载前预留磁盘空间: 淘汰全部缓存也放不下或等待超时时失败，暂时不够时登记到等待队列并返回False"""
+    if not needed:
+        return True
+    if needed > disk_ledger.capacity_bytes():
+        raise Exception(f'磁盘空间不足，无法处理这个视频 (需要约 {needed // (1024 * 1024)} MB)')
     
-    ydl_opts_video = {
-        'format': 'best[height<=720]/best',
-        'outtmpl': mp4_filepath.replace('.mp4', '.%(ext)s'),
-        'quiet': False,
-        'no_warnings': False,
-        'socket_timeout': 120,
-        'retries': 3,
-        'nocheckcertificate': True,
-        'extract_flat': False,
-        'ignoreerrors': False,
-    }
+    if disk_ledger.reserve(task.task_id, needed):
+        with disk_waiters_lock:
+            disk_waiters.pop(task.task_id, None)
+        if 'disk' in task.stages:
+            task.stages = dict(task.stages, disk={'waiting': False, 'required_bytes': needed})
+        return True
     
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts_video) as ydl:
-            ydl.download([task.url])
-            
-        # 查找下载的视频文件
-        video_file_found = False
-        for file in os.listdir(TEMP_DIR):
-            if video_id in file and (file.endswith('.mp4') or file.endswith('.webm') or file.endswith('.mkv')):
-                actual_filepath = os.path.join(TEMP_DIR, file)
-                # 如果不是mp4，重命名为mp4
-                if not file.endswith('.mp4'):
-                    new_filepath = os.path.join(TEMP_DIR, f"{video_id}_{safe_title}.mp4")
-                    os.rename(actual_filepath, new_filepath)
-                    actual_filepath = new_filepath
-                
-                task.files = task.files or {}
-                task.files['mp4_720'] = {
-                    'filename': f"{safe_title}.mp4",
-                    'path': actual_filepath,
-                    'size': os.path.getsize(actual_filepath),
-                    'download_url': f'/api/download/{task.task_id}/mp4_720'
-                }
-                video_file_found = True
-                print(f"视频文件下载成功: {actual_filepath}")
-                break
-                
-        if not video_file_found:
-            print("视频下载失败，但音频成功")
-            
-    except Exception as e:
-        print(f"视频下载出错: {e}")
-        # 视频下载失败不是致命错误，只要音频成功就行
-        
-    task.progress = 90
-    print(f"下载完成，生成了 {len(task.files)} 个文件")
+    with disk_waiters_lock:
+        waiter = disk_waiters.get(task.task_id)
+        if waiter is not None and time.time() > waiter['deadline']:
+            del disk_waiters[task.task_id]
+            raise Exception('磁盘空间不足，请稍后重试')
+        if waiter is None:
+            waiter = disk_waiters[task.task_id] = {'deadline': time.time() + DISK_WAIT_TIMEOUT}
+            print(f"等待磁盘空间: {task.task_id} 需要 {needed // (1024 * 1024)} MB")
+        waiter['needed'] = needed
+        waiter['queued'] = False
+    task.stages = dict(task.stages, disk={'waiting': True, 'required_bytes': needed})
+    return False
+
+def retry_disk_waiters():
+    """空间够用 (已为任务预留) 或等待超时的任务重新提交到转换线程池"""
+    with disk_waiters_lock:
+        waiting = list(disk_waiters.items())
+    for task_id, waiter in waiting:
+        task = tasks.get(task_id)
+        if task is None or task.status != 'processing':
+            # 重新提交后已经结束 (例如其他任务生成了缓存) 的任务
+            with disk_waiters_lock:
+                disk_waiters.pop(task_id, None)
+            continue
+        if waiter['queued']:
+            continue
+        if disk_ledger.reserve(task_id, waiter['needed']) or time.time() > waiter['deadline']:
+            with disk_waiters_lock:
+                waiter['queued'] = True
+            conversion_pool.submit(task_id, perform_conversion, task_id, force=True)
+
+def start_disk_wait():
+    def disk_wait_loop():
+        while True:
+            # 其他worker释放空间时收不到通知，定时重试
+            with conversion_cache.space_freed:
+                conversion_cache.space_freed.wait(DISK_RETRY_SECONDS)
+            try:
+                retry_disk_waiters()
+            except Exception as e:
+                print(f"Disk wait error: {e}")
+    
+    threading.Thread(target=disk_wait_loop, daemon=True).start()
+
+def download_progress_hook(task, index, count):
+    """yt-dlp进度回调: 下载占总进度的20%-70%，多个源流平分"""
+    def hook(d):
+        if d.get('status') not in ('downloading', 'finished'):
+            return
+        downloaded = d.get('downloaded_bytes') or 0
+        total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+        if d['status'] == 'finished':
+            fraction = 1
+        else:
+            fraction = min(downloaded / total, 1) if total else 0
+        task.stages = dict(task.stages, download={
+            'downloaded_bytes': downloaded,
+            'total_bytes': total,
+            'speed': d.get('speed'),
+            'eta': d.get('eta'),
+            'stream': index + 1,
+            'streams': count,
+        })
+        task.progress = 20 + int(50 * (index + fraction) / count)
+    return hook
+
+def safe_title(title):
+    """文件名中使用的标题，只保留字母数字和少数符号"""
+    return "".join(c for c in title[:50] if c.isalnum() or c in (' ', '-', '_')).strip()
+
+def downloaded_path(ydl, result):
+    """yt-dlp实际写出的文件路径 (后处理之后的最终路径)，不扫描目录"""
+    for download in (result or {}).get('requested_downloads') or []:
+        if download.get('filepath') and os.path.exists(download['filepath']):
+            return download['filepath']
+    filepath = ydl.prepare_filename(result) if result else None
+    return filepath if filepath and os.path.exists(filepath) else None
 
 # 移除旧的降级函数，现在只进行真实下载
 
 @app.route('/api/status/<task_id>', methods=['GET'])
 def get_conversion_status(task_id):
-    if task_id not in tasks:
+    task = find_task(task_id)
+    if task is None:
         return jsonify({'error': 'Task not found'}), 404
     
-    task = tasks[task_id]
+    # 长轮询: ?since=<version> 时等到状态变化或超时再返回
+    since = request.args.get('since', type=int)
+    if since is not None:
+        # 挂起的连接已满时不等待，让客户端稍后再查
+        if not status_watchers.acquire(blocking=False):
+            status = build_status(task)
+            status['poll_after'] = STATUS_SHORT_POLL_SECONDS
+            return jsonify(status)
+        try:
+            timeout = min(request.args.get('timeout', LONG_POLL_TIMEOUT, type=float), LONG_POLL_TIMEOUT)
+            task = wait_task(task, since, timeout)
+        finally:
+            status_watchers.release()
+    
+    return jsonify(build_status(task))
+
+@app.route('/api/status/<task_id>/stream', methods=['GET'])
+def stream_conversion_status(task_id):
+    """Server-Sent Events: 状态变化时推送，任务结束后关闭"""
+    task = find_task(task_id)
+    if task is None:
+        return jsonify({'error': 'Task not found'}), 404
+    
+    # 挂起的连接已满时拒绝，客户端改用短轮询
+    if not status_watchers.acquire(blocking=False):
+        response = jsonify({'error': '状态推送连接已满，请使用轮询', 'poll_after': STATUS_SHORT_POLL_SECONDS})
+        response.headers['Retry-After'] = str(STATUS_SHORT_POLL_SECONDS)
+        return response, 503
+    
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    initial_task = task
+    
+    def generate():
+        task = initial_task
+        version = last_event_id
+        while True:
+            if task.version != version:
+                version = task.version
+                status = build_status(task)
+                yield f"id: {version}\nevent: status\ndata: {json.dumps(status)}\n\n"
+                if status['status'] in ('completed', 'error'):
+                    return
+                # 合并短时间内的多次变化
+                time.sleep(STATUS_PUSH_INTERVAL)
+            else:
+                task = wait_task(task, version, SSE_KEEPALIVE_SECONDS)
+                if task.version == version:
+                    yield ": keepalive\n\n"
+    
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    # 连接结束 (包括客户端断开) 时归还名额
+    response.call_on_close(status_watchers.release)
+    return response
+
+def build_status(task):
+    """/api/status 返回的任务状态"""
+    # 合并进来的任务使用主任务的进度
+    source = task
+    if task.leader is not None and task.status == 'processing':
+        source = task.leader
     
     response = {
-        'task_id': task_id,
+        'task_id': task.task_id,
+        'version': task.version,
         'status': task.status,
-        'progress': task.progress,
+        'progress': source.progress,
+        'stages': source.stages,
         'video_info': task.video_info,
         'error': task.error
     }
     
+    if task.status == 'pending' and task.task_id in tasks:
+        response['queue_position'] = conversion_pool.position(task.task_id)
+    
     if task.status == 'completed' and task.files:
+        response['bundle_url'] = f'/api/download/{task.task_id}/bundle'
         response['files'] = {}
         for format_type, file_info in task.files.items():
+            # 已被缓存淘汰的文件不再提供下载
+            if not os.path.exists(file_info.get('path', '')):
+                response['files_evicted'] = True
+                continue
             response['files'][format_type] = {
                 'filename': file_info['filename'],
                 'size': file_info['size'],
                 'download_url': file_info['download_url']
             }
     
-    return jsonify(response)
+    return response
 
 @app.route('/api/download/<task_id>/<format_type>', methods=['GET', 'OPTIONS'])
 def download_file(task_id, format_type):
@@ -442,11 +2391,14 @@ def download_file(task_id, format_type):
         
     print(f"Download request: task_id={task_id}, format_type={format_type}")
     
-    if task_id not in tasks:
+    task = find_task(task_id)
+    if task is None:
         print(f"Task {task_id} not found")
         abort(404)
     
-    task = tasks[task_id]
+    # 流式模式: 文件还没生成时边转码边发送
+    if request.args.get('stream') and format_type not in (task.files or {}):
+        return stream_conversion(task, format_type)
     
     if not task.files or format_type not in task.files:
         print(f"Format {format_type} not found in task files: {task.files}")
@@ -457,40 +2409,483 @@ def download_file(task_id, format_type):
     
     # 只发送真实文件
     if 'path' in file_info and os.path.exists(file_info['path']):
-        print(f"Sending file: {file_info['path']}")
-        return send_file(
+        return send_file_ranges(
             file_info['path'],
-            as_attachment=True,
-            download_name=file_info['filename'],
-            mimetype='audio/mpeg' if format_type.startswith('mp3') else 'video/mp4'
+            file_info['filename'],
+            MIME_TYPES.get(format_type.split('_')[0], 'application/octet-stream')
         )
     else:
         print(f"File not found: {file_info.get('path', 'No path specified')}")
         abort(404)
 
-# 清理旧文件
-def cleanup_old_files():
+def send_file_ranges(path, filename, mimetype):
+    """发送文件: 内容哈希作为强ETag，支持If-None-Match、If-Range和单个/多个Range"""
+    size = os.path.getsize(path)
+    etag = conversion_cache.digest(path)
+    headers = {
+        'ETag': f'"{etag}"',
+        'Last-Modified': http_date(os.path.getmtime(path)),
+        'Accept-Ranges': 'bytes',
+        'Content-Disposition': f"attachment; filename*=UTF-8''{quote(filename)}",
+    }
+    
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=headers)
+    
+    spans = requested_ranges(size, etag, headers['Last-Modified'])
+    if spans == []:
+        headers['Content-Range'] = f'bytes */{size}'
+        return Response(status=416, headers=headers)
+    
+    if spans is None:
+        status = 200
+        parts = [(0, size)]
+        length = size
+    elif len(spans) == 1:
+        status = 206
+        start, stop = spans[0]
+        parts = spans
+        length = stop - start
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+    else:
+        # 多个Range: multipart/byteranges
+        status = 206
+        boundary = os.urandom(12).hex()
+        parts = []
+        for start, stop in spans:
+            parts.append((f'--{boundary}\r\nContent-Type: {mimetype}\r\n'
+                          f'Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n').encode())
+            parts.append((start, stop))
+            parts.append(b'\r\n')
+        parts.append(f'--{boundary}--\r\n'.encode())
+        length = sum(len(part) if isinstance(part, bytes) else part[1] - part[0] for part in parts)
+        mimetype = f'multipart/byteranges; boundary={boundary}'
+    
+    headers['Content-Length'] = str(length)
+    print(f"Sending file: {path} ({status})")
+    # 文件流发送完毕后才释放引用
+    conversion_cache.acquire(path)
+    body = ClosingIterator(read_file_parts(path, parts), lambda: conversion_cache.release(path))
+    return Response(body, status=status, headers=headers, mimetype=mimetype, direct_passthrough=True)
+
+BYTE_RANGE_PATTERN = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+def requested_ranges(size, etag, last_modified):
+    """解析Range头，返回合并后的 [(start, stop)]；不是Range请求或If-Range不匹配时返回None，
+    全部范围都无法满足时返回空列表"""
+    header = request.headers.get('Range')
+    if not header:
+        return None
+    if 'If-Range' in request.headers:
+        # 文件已变化时忽略Range，返回整个文件
+        if_range = request.if_range
+        if if_range.etag != etag and not (if_range.date and http_date(if_range.date) == last_modified):
+            return None
+    units, _, specs = header.partition('=')
+    if units.strip().lower() != 'bytes':
+        return None
+    
+    # 允许乱序和重叠的范围 (werkzeug的parse_range_header会拒绝)
+    spans = []
+    for spec in specs.split(','):
+        match = BYTE_RANGE_PATTERN.match(spec)
+        if match is None:
+            return None
+        first, last = match.groups()
+        if not first and not last:
+            return None
+        if not first:
+            start, stop = max(size - int(last), 0), size
+        else:
+            start = int(first)
+            stop = size if not last else min(int(last) + 1, size)
+            if last and int(last) < start:
+                return None
+        if start < stop:
+            spans.append((start, stop))
+    
+    # 合并重叠和相邻的范围
+    merged = []
+    for start, stop in sorted(spans):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    if len(merged) > MAX_RANGES:
+        return None
+    return merged
+
+def read_file_parts(path, parts):
+    """依次生成字节串和文件中 [start, stop) 范围的内容"""
+    with open(path, 'rb') as f:
+        for part in parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            start, stop = part
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = f.read(min(STREAM_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+@app.route('/api/download/<task_id>/bundle', methods=['GET', 'OPTIONS'])
+def download_bundle(task_id):
+    """一个ZIP下载任务的所有输出文件"""
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'ok'})
+    
+    task = find_task(task_id)
+    if task is None or task.status != 'completed' or not task.files:
+        abort(404)
+    
+    entries = []
+    names = set()
+    for format_type, file_info in sorted(task.files.items()):
+        if not os.path.exists(file_info.get('path', '')):
+            abort(404)
+        entries.append((unique_name(file_info['filename'], names), file_info['path']))
+    
+    title = safe_title((task.video_info or {}).get('title') or task.task_id)
+    return zip_response(entries, f'{title}.zip')
+
+# 进行中的流式转码: (视频ID, 格式) -> StreamProducer，同一个视频只运行一个ffmpeg
+stream_producers = {}
+
+class StreamProducer:
+    """一个ffmpeg流式转码: 输出写入临时文件，多个下载请求跟随读取"""
+
+    def __init__(self, key, command, temp_path, final_path, filename):
+        self.key = key
+        self.command = command
+        self.temp_path = temp_path
+        self.final_path = final_path
+        self.filename = filename
+        self.process = None
+        self.readers = 0
+        self.written = 0
+        self.done = False
+        self.ok = False
+        self.changed = threading.Condition()
+
+    def start(self):
+        # 先创建文件，跟随的请求随时可以打开
+        open(self.temp_path, 'wb').close()
+        self.process = subprocess.Popen(self.command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        ok = False
+        try:
+            with open(self.temp_path, 'wb') as cache_file:
+                while True:
+                    chunk = self.process.stdout.read1(STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    cache_file.write(chunk)
+                    cache_file.flush()
+                    with self.changed:
+                        self.written += len(chunk)
+                        self.changed.notify_all()
+            ok = self.process.wait() == 0
+            if ok:
+                publish_artifact(self.temp_path, self.final_path)
+                conversion_cache.put(self.key[0], self.key[1], self.final_path, self.filename)
+                print(f"流式转换完成: {self.final_path}")
+        except Exception as e:
+            ok = False
+            print(f"Streaming error: {e}")
+        finally:
+            if self.process.poll() is None:
+                self.process.kill()
+                self.process.wait()
+            with inflight_lock:
+                if stream_producers.get(self.key) is self:
+                    del stream_producers[self.key]
+            # 不完整的文件丢弃 (已打开的读者仍能读完已写入的部分)
+            if not ok and os.path.exists(self.temp_path):
+                os.remove(self.temp_path)
+            with self.changed:
+                self.ok = ok
+                self.done = True
+                self.changed.notify_all()
+
+    def open(self):
+        """打开输出文件 (调用方持有inflight_lock)；已经发布时打开最终文件"""
+        for path in (self.temp_path, self.final_path):
+            try:
+                handle = open(path, 'rb')
+            except FileNotFoundError:
+                continue
+            self.readers += 1
+            return handle
+        return None
+
+    def leave(self, handle):
+        """读者离开，最后一个读者断开时结束还没完成的ffmpeg"""
+        handle.close()
+        with inflight_lock:
+            self.readers -= 1
+            if self.readers > 0 or self.done:
+                return
+            if stream_producers.get(self.key) is self:
+                del stream_producers[self.key]
+        if self.process.poll() is None:
+            self.process.kill()
+
+    def follow(self, handle):
+        """从头读取输出文件，追上ffmpeg后等待新的数据"""
+        offset = 0
+        while True:
+            with self.changed:
+                self.changed.wait_for(lambda: self.written > offset or self.done)
+                written, done = self.written, self.done
+            if written > offset:
+                chunk = handle.read(min(STREAM_CHUNK_SIZE, written - offset))
+                if not chunk:
+                    return
+                offset += len(chunk)
+                yield chunk
+            elif done:
+                return
+
+def stream_conversion(task, format_type):
+    """ffmpeg直接读取音频流并转成MP3，输出一边分块发送一边写入缓存文件；同一个视频的并发请求共用一个ffmpeg"""
+    if SUPPORTED_FORMATS.get(format_type, (None,))[0] != 'mp3':
+        abort(400)
+    
+    # 转换任务还没提取信息时在这里提取
+    if not task.stream_formats:
+        try:
+            video_info = get_real_video_info(task.url)
+        except Exception as e:
+            print(f"Stream extraction failed: {e}")
+            return jsonify({'error': f'获取视频信息失败: {str(e)}'}), 502
+        task.stream_formats = video_info.pop('formats', [])
+        task.video_info = task.video_info or video_info
+    
+    video_id = task.video_info['id']
+    title = safe_title(task.video_info['title'])
+    
+    # 其他任务已经转换好的直接发送
+    entry = conversion_cache.get(video_id, format_type)
+    if entry is not None:
+        return send_file_ranges(entry['path'], entry['filename'], MIME_TYPES['mp3'])
+    
+    key = (video_id, format_type)
+    with inflight_lock:
+        producer = stream_producers.get(key)
+        handle = producer.open() if producer is not None else None
+    
+    if handle is None:
+        stream = select_stream(task.stream_formats, None) or select_stream(task.stream_formats, 100000)
+        if stream is None or not stream.get('url'):
+            abort(404)
+        
+        bitrate = SUPPORTED_FORMATS[format_type][1]
+        final_path = artifact_path(video_id, format_type)
+        # 每个转码使用随机的临时文件名，不会和其他转码写同一个文件
+        temp_path = staging_path(final_path, f'{os.urandom(6).hex()}.streaming')
+        
+        command = ['ffmpeg', '-nostdin', '-loglevel', 'error']
+        headers = ''.join(f'{name}: {value}\r\n' for name, value in (stream.get('http_headers') or {}).items())
+        if headers:
+            command += ['-headers', headers]
+        command += [
+            '-reconnect', '1', '-reconnect_streamed', '1',
+            '-i', stream['url'],
+            '-vn', '-codec:a', 'libmp3lame', '-b:a', f'{bitrate}k',
+            '-f', 'mp3', 'pipe:1'
+        ]
+        
+        with inflight_lock:
+            # 提取期间可能已经有其他请求启动了转码
+            producer = stream_producers.get(key)
+            if producer is None:
+                producer = StreamProducer(key, command, temp_path, final_path, f"{title}.mp3")
+                try:
+                    producer.start()
+                except OSError as e:
+                    print(f"Streaming failed to start: {e}")
+                    return jsonify({'error': '流式转换失败'}), 502
+                stream_producers[key] = producer
+            handle = producer.open()
+        if handle is None:
+            return jsonify({'error': '流式转换失败'}), 502
+        print(f"Streaming {format_type} for task {task.task_id}")
+    else:
+        print(f"Following stream {format_type} for task {task.task_id}")
+    
+    response = Response(producer.follow(handle), mimetype=MIME_TYPES['mp3'])
+    response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(title + '.mp3')}"
+    response.call_on_close(lambda: producer.leave(handle))
+    return response
+
+def cleanup_orphan_files():
+    """删除没有登记在索引中的残留文件 (失败任务的源文件、中断的临时文件)"""
     try:
         current_time = time.time()
-        for filename in os.listdir(TEMP_DIR):
-            filepath = os.path.join(TEMP_DIR, filename)
-            if os.path.isfile(filepath):
-                file_age = current_time - os.path.getctime(filepath)
-                if file_age > 7200:  # 2小时
-                    os.remove(filepath)
+        for directory, subdirs, filenames in os.walk(TEMP_DIR, topdown=False):
+            for filename in filenames:
+                filepath = os.path.join(directory, filename)
+                # sidecar跟随文件一起处理；正在使用的文件不能删除
+                if filename.endswith('.json') and os.path.exists(filepath[:-5]):
+                    continue
+                if conversion_cache.is_pinned(filepath) or conversion_cache.index.find_by_path(filepath):
+                    continue
+                if current_time - os.path.getctime(filepath) > ORPHAN_MAX_AGE:
+                    remove_artifact(filepath)
     except Exception as e:
         print(f"Cleanup error: {e}")
 
+def compact_tasks():
+    """结束超过TASK_HOT_SECONDS或文件已被淘汰的任务移出内存 (之后从存储读取)，超过TASK_TTL的记录从存储删除"""
+    now = time.time()
+    removed = 0
+    for task_id, task in list(tasks.items()):
+        if task.finished_at is None:
+            continue
+        evicted = any(not os.path.exists(file_info.get('path', '')) for file_info in (task.files or {}).values())
+        if evicted or now - task.finished_at > TASK_HOT_SECONDS:
+            tasks.pop(task_id, None)
+            removed += 1
+    try:
+        expired = task_store.expire(Task.FINISHED_STATUSES + ('batch',), now - TASK_TTL)
+    except Exception as e:
+        print(f"Task store error: {e}")
+        expired = 0
+    if removed or expired:
+        print(f"任务整理: 移出内存 {removed} 个，删除过期记录 {expired} 个")
+
+def preload_heavy_modules():
+    """导入yt-dlp并加载YouTube提取器；gunicorn --preload 时在master中调用，fork后的worker直接共享"""
+    try:
+        import yt_dlp
+        with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
+            ydl.get_info_extractor('Youtube')
+    except Exception as e:
+        print(f"Preload error: {e}")
+
+background_pid = None
+background_lock = threading.Lock()
+
+def start_background_tasks():
+    """每个进程启动一次后台线程并预热YoutubeDL实例 (gunicorn的post_fork钩子或第一个请求触发)"""
+    global background_pid
+    with background_lock:
+        if background_pid == os.getpid():
+            return
+        background_pid = os.getpid()
+    start_cleanup()
+    start_resume()
+    start_disk_wait()
+    start_persist()
+    threading.Thread(target=ydl_pool.warm, daemon=True).start()
+
+@app.before_request
+def ensure_background_tasks():
+    start_background_tasks()
+
+def start_persist():
+    def persist_loop():
+        while True:
+            time.sleep(PERSIST_INTERVAL)
+            flush_dirty_tasks()
+    
+    threading.Thread(target=persist_loop, daemon=True).start()
+
 def start_cleanup():
     def cleanup_loop():
+        # 写入缓存时已经按水位淘汰，这里兜底处理磁盘被其他文件占满的情况
+        last_orphan_sweep = time.time()
         while True:
-            time.sleep(3600)  # 每小时清理一次
-            cleanup_old_files()
+            time.sleep(CACHE_SWEEP_INTERVAL)
+            try:
+                conversion_cache.evict()
+            except Exception as e:
+                print(f"Cache evict error: {e}")
+            compact_tasks()
+            if time.time() - last_orphan_sweep >= ORPHAN_SWEEP_INTERVAL:
+                last_orphan_sweep = time.time()
+                cleanup_orphan_files()
     
     threading.Thread(target=cleanup_loop, daemon=True).start()
 
-start_cleanup()
+def owner_is_gone(record):
+    """记录中的worker进程是否已经退出"""
+    owner = record.get('owner') or ''
+    if owner == worker_id():
+        return False
+    parts = owner.rsplit(':', 2)
+    if len(parts) == 3 and parts[0] == socket.gethostname() and parts[1].isdigit():
+        pid = int(parts[1])
+        # 本机同一个pid: 启动时间不同说明是重启前的进程
+        if pid == os.getpid():
+            return True
+        started = process_start_time(pid)
+        if started is not None:
+            return started != parts[2]
+        if os.name != 'nt':
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                return True
+            except OSError:
+                pass
+    # 其他主机 (或无法检查进程的系统) 按最后更新时间判断
+    return time.time() - record.get('updated_at', 0) > RESUME_STALE_SECONDS
+
+def resume_tasks():
+    """接管中断的任务: 源文件已下载的直接转码，其余重新下载 (yt-dlp会续传.part文件)"""
+    for status in ('pending', 'processing'):
+        for record in task_store.find_by_status(status):
+            if record['task_id'] in tasks or not owner_is_gone(record):
+                continue
+            record = task_store.claim(record['task_id'], record.get('owner'), worker_id())
+            if record is None:
+                continue
+            
+            task = Task.restore(record)
+            tasks[task.task_id] = task
+            checkpoint = task.checkpoint or {}
+            jobs = checkpoint.get('jobs')
+            if checkpoint.get('stage') == 'transcode' and jobs and all(os.path.exists(job[0]) for job in jobs):
+                print(f"恢复转码: {task.task_id}")
+                task.produce = tuple(fmt for job in jobs for fmt, output_path, filename in job[1])
+                with inflight_lock:
+                    for fmt in task.produce:
+                        key = (task.video_info['id'], fmt)
+                        if inflight.setdefault(key, task) is task:
+                            task.inflight_keys.append(key)
+                task.status = 'processing'
+                transcode_pool.submit(task.task_id, perform_transcode, task.task_id, jobs)
+            else:
+                print(f"恢复下载: {task.task_id}")
+                task.checkpoint = None
+                task.files = {}
+                task.status = 'pending'
+                conversion_pool.submit(task.task_id, perform_conversion, task.task_id, force=True)
+
+def start_resume():
+    def resume_loop():
+        # 定期刷新本进程未完成任务的更新时间，避免被其他进程当作中断任务接管；
+        # 每轮都重新扫描，部署时其他主机上还没过期的任务之后才能接管
+        while True:
+            try:
+                resume_tasks()
+            except Exception as e:
+                print(f"Resume error: {e}")
+            time.sleep(max(RESUME_STALE_SECONDS // 3, 1))
+            for task in list(tasks.values()):
+                if task.status in ('pending', 'processing'):
+                    save_task(task)
+    
+    threading.Thread(target=resume_loop, daemon=True).start()
 
 if __name__ == '__main__':
+    start_background_tasks()
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False) 
\ No newline at end of file
@@ -140,13 +140,12 @@ def perform_conversion(task_id):
         # 下载文件
         config = get_ultra_safe_ydl_config()
         with yt_dlp.YoutubeDL(config) as ydl:
-            ydl.download([task.url])
+            result = ydl.extract_info(task.url, download=True)
         
-        # 查找下载的文件
-        video_id = task.video_info['id']
-        for file in os.listdir(TEMP_DIR):
-            if video_id in file and file.endswith('.mp3'):
-                filepath = os.path.join(TEMP_DIR, file)
+        # yt-dlp返回转成mp3之后的实际路径，不用扫描目录
+        for download in result.get('requested_downloads') or []:
+            filepath = download.get('filepath')
+            if filepath and os.path.exists(filepath):
                 task.files['mp3_256'] = {
                     'filename': f"{task.video_info['title'][:50]}.mp3",
                     'path': filepath,
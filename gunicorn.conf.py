@@ -0,0 +1,12 @@
+# gunicorn配置，配合 --preload 使用:
+# master进程预先导入yt-dlp和提取器，fork出的worker共享这部分内存；
+# 线程、数据库连接和YoutubeDL实例在每个worker中fork之后再创建
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        import app
+        app.preload_heavy_modules()
+
+def post_fork(server, worker):
+    import app
+    app.start_background_tasks()
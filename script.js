@@ -5,7 +5,8 @@ let batchQueue = [];
 let isConverting = false;
 let autoConvertTimeout;
 let currentTaskId = null;
-let statusCheckInterval = null;
+let statusEventSource = null;
+let statusPolling = false;
 let selectedFormat = 'mp3'; // 默认选择MP3格式
 
 // API配置 - 动态检测环境
@@ -331,6 +332,12 @@ async function startConversion() {
             })
         });
         
+        if (response.status === 503) {
+            const busy = await response.json().catch(() => ({}));
+            const retryAfter = busy.retry_after || response.headers.get('Retry-After') || 30;
+            throw new Error(`Server is busy, please try again in ${retryAfter} seconds`);
+        }
+        
         if (!response.ok) {
             throw new Error(`HTTP error! status: ${response.status}`);
         }
@@ -355,114 +362,160 @@ async function startConversion() {
         inputStatus.innerHTML = '<i class="fas fa-check-circle"></i>';
         inputStatus.className = 'input-status valid';
         
-        // Clear status check interval
-        if (statusCheckInterval) {
-            clearInterval(statusCheckInterval);
-            statusCheckInterval = null;
-        }
+        // Stop status monitoring
+        stopStatusMonitor();
     }
 }
 
 // Monitor conversion progress
+// 优先使用SSE推送，不支持或连接失败时改用长轮询
 async function monitorConversionProgress(taskId) {
     return new Promise((resolve, reject) => {
-        statusCheckInterval = setInterval(async () => {
+        const finish = (error) => {
+            stopStatusMonitor();
+            error ? reject(error) : resolve();
+        };
+        
+        const onStatus = (status) => {
             try {
-                const response = await fetchWithCORS(`${API_BASE_URL}/status/${taskId}`);
-                if (!response.ok) {
-                    throw new Error(`HTTP error! status: ${response.status}`);
-                }
-                
-                const status = await response.json();
-                
-                // 安全检查状态对象
-                if (!status || typeof status !== 'object') {
-                    throw new Error('Invalid status response');
-                }
-                
-                // 确保progress是数字
-                const progress = typeof status.progress === 'number' ? status.progress : 0;
-                
-                // Update progress UI
-                const progressFill = document.getElementById('progress-fill');
-                const progressText = document.getElementById('progress-text');
-                
-                if (progressFill) {
-                    progressFill.style.width = `${progress}%`;
+                if (handleStatusUpdate(status, taskId)) {
+                    finish();
                 }
-                if (progressText) {
-                    progressText.textContent = `${progress}%`;
-                }
-                
-                // Update status text based on progress
-                if (progress < 20) {
-                    updateConversionStatus('Downloading video...');
-                } else if (progress < 40) {
-                    updateConversionStatus('Extracting audio...');
-                } else if (progress < 60) {
-                    updateConversionStatus('Converting formats...');
-                } else if (progress < 80) {
-                    updateConversionStatus('Optimizing quality...');
-                } else if (progress < 100) {
-                    updateConversionStatus('Finalizing files...');
-                } else {
-                    updateConversionStatus('Conversion complete!');
-                }
-                
-                if (status.status === 'completed') {
-                    clearInterval(statusCheckInterval);
-                    statusCheckInterval = null;
-                    
-                    // 调试：记录完整的status响应
-                    console.log('Conversion completed, status:', status);
-                    
-                    // 安全检查响应数据
-                    const files = status.files || {};
-                    const videoInfo = status.video_info || {};
-                    
-                    console.log('Files object:', files);
-                    console.log('Files keys:', Object.keys(files));
-                    console.log('Files length:', Object.keys(files).length);
-                    
-                    // 显示下载链接 - 移除严格检查，总是尝试显示
-                    try {
-                        displayRealDownloadItems(files, videoInfo);
-                        
-                        // Add to history
-                        addToHistory({
-                            url: document.getElementById('youtube-url').value.trim(),
-                            videoInfo: videoInfo,
-                            timestamp: new Date().toISOString(),
-                            taskId: taskId,
-                            files: files
-                        });
-                        
-                        showNotification('Conversion completed!', 'success');
-                    } catch (displayError) {
-                        console.error('Display error:', displayError);
-                        showNotification('Conversion completed but display failed', 'warning');
+            } catch (error) {
+                finish(error);
+            }
+        };
+        
+        const longPoll = async (version) => {
+            statusPolling = true;
+            while (statusPolling) {
+                try {
+                    const query = version === null ? '' : `?since=${version}`;
+                    const response = await fetchWithCORS(`${API_BASE_URL}/status/${taskId}${query}`);
+                    if (!response.ok) {
+                        throw new Error(`HTTP error! status: ${response.status}`);
                     }
-                    
-                    // Hide progress section
-                    document.getElementById('progress-section').style.display = 'none';
-                    
-                    resolve();
-                    
-                } else if (status.status === 'error') {
-                    clearInterval(statusCheckInterval);
-                    statusCheckInterval = null;
-                    throw new Error(status.error || 'Conversion failed');
+                    const status = await response.json();
+                    version = status.version;
+                    onStatus(status);
+                    // 服务器挂起的连接已满时返回 poll_after，间隔一段时间再查
+                    if (statusPolling && status.poll_after) {
+                        await new Promise(r => setTimeout(r, status.poll_after * 1000));
+                    }
+                } catch (error) {
+                    finish(error);
                 }
-                
-            } catch (error) {
-                clearInterval(statusCheckInterval);
-                statusCheckInterval = null;
-                reject(error);
             }
-        }, 2000); // Check every 2 seconds
+        };
+        
+        if (!window.EventSource) {
+            longPoll(null);
+            return;
+        }
+        
+        let lastVersion = null;
+        statusEventSource = new EventSource(`${API_BASE_URL}/status/${taskId}/stream`);
+        statusEventSource.addEventListener('status', (event) => {
+            const status = JSON.parse(event.data);
+            lastVersion = status.version;
+            onStatus(status);
+        });
+        statusEventSource.onerror = () => {
+            if (!statusEventSource) return;
+            statusEventSource.close();
+            statusEventSource = null;
+            longPoll(lastVersion);
+        };
     });
 }
 
+// Stop SSE / long-poll status monitoring
+function stopStatusMonitor() {
+    statusPolling = false;
+    if (statusEventSource) {
+        statusEventSource.close();
+        statusEventSource = null;
+    }
+}
+
+// Apply one status update to the UI, returns true when conversion is complete
+function handleStatusUpdate(status, taskId) {
+    // 安全检查状态对象
+    if (!status || typeof status !== 'object') {
+        throw new Error('Invalid status response');
+    }
+    
+    // 确保progress是数字
+    const progress = typeof status.progress === 'number' ? status.progress : 0;
+    
+    // Update progress UI
+    const progressFill = document.getElementById('progress-fill');
+    const progressText = document.getElementById('progress-text');
+    
+    if (progressFill) {
+        progressFill.style.width = `${progress}%`;
+    }
+    if (progressText) {
+        progressText.textContent = `${progress}%`;
+    }
+    
+    // Update status text from the reported stage
+    const stages = status.stages || {};
+    if (status.queue_position) {
+        updateConversionStatus(`Waiting in queue (position ${status.queue_position})...`);
+    } else if (status.status === 'completed') {
+        updateConversionStatus('Conversion complete!');
+    } else if (stages.transcode) {
+        updateConversionStatus(`Converting formats...${formatEta(stages.transcode.eta)}`);
+    } else if (stages.download) {
+        const speed = stages.download.speed ? ` ${formatFileSize(stages.download.speed)}/s` : '';
+        updateConversionStatus(`Downloading video...${speed}${formatEta(stages.download.eta)}`);
+    } else {
+        updateConversionStatus('Getting video information...');
+    }
+    
+    if (status.status === 'completed') {
+        // 调试：记录完整的status响应
+        console.log('Conversion completed, status:', status);
+        
+        // 安全检查响应数据
+        const files = status.files || {};
+        const videoInfo = status.video_info || {};
+        
+        console.log('Files object:', files);
+        console.log('Files keys:', Object.keys(files));
+        console.log('Files length:', Object.keys(files).length);
+        
+        // 显示下载链接 - 移除严格检查，总是尝试显示
+        try {
+            displayRealDownloadItems(files, videoInfo);
+            
+            // Add to history
+            addToHistory({
+                url: document.getElementById('youtube-url').value.trim(),
+                videoInfo: videoInfo,
+                timestamp: new Date().toISOString(),
+                taskId: taskId,
+                files: files
+            });
+            
+            showNotification('Conversion completed!', 'success');
+        } catch (displayError) {
+            console.error('Display error:', displayError);
+            showNotification('Conversion completed but display failed', 'warning');
+        }
+        
+        // Hide progress section
+        document.getElementById('progress-section').style.display = 'none';
+        
+        return true;
+    } else if (status.status === 'error') {
+        throw new Error(status.error || 'Conversion failed');
+    }
+    
+    return false;
+}
+
 function displayVideoInfo(videoInfo) {
     if (!videoInfo) {
         console.error('Video info is null or undefined');
@@ -672,6 +725,14 @@ function formatFileSize(bytes) {
     return parseFloat((bytes / Math.pow(k, i)).toFixed(2)) + ' ' + sizes[i];
 }
 
+// Helper function to format the remaining time reported by the server
+function formatEta(seconds) {
+    if (typeof seconds !== 'number' || seconds <= 0) return '';
+    const minutes = Math.floor(seconds / 60);
+    const secs = Math.round(seconds % 60);
+    return minutes > 0 ? ` (${minutes}m ${secs}s left)` : ` (${secs}s left)`;
+}
+
 // History functionality
 function addToHistory(fileInfo) {
     try {